@@ -63,6 +63,16 @@ az storage account create \
     --name $STORAGE_ACCOUNT_NAME \
     --sku Standard_LRS
 
+# ブラウザから Blob Storage へ直接アップロードできるように CORS を設定する
+az storage cors add \
+    --account-name $STORAGE_ACCOUNT_NAME \
+    --services b \
+    --methods PUT OPTIONS \
+    --origins "https://$WEBAPP_NAME.azurewebsites.net" \
+    --allowed-headers "*" \
+    --exposed-headers "*" \
+    --max-age 3600
+
 # Azure Cosmos DB アカウントを作成する
 az cosmosdb create \
     --resource-group $RESOURCE_GROUP_NAME \
@@ -78,18 +88,25 @@ az cosmosdb sql database create \
     --name $COSMOS_DB_NAME
 
 # Azure Cosmos DB コンテナを作成する
+# インデックスポリシー(cosmos/*-indexing-policy.json)では、サイズの大きいフィールドをインデックスの対象から除外し、
+# 一覧取得APIのクエリ(所有ユーザ・種類・情報源グループで絞り込み、作成日時の降順に並べる)用の複合インデックスを定義する
+# 作成済みのコンテナには "az cosmosdb sql container update --idx @cosmos/docs-indexing-policy.json" で適用できる
+# ドキュメントのコンテナでは、登録されなかったアップロード中のドキュメントを有効期限(ttl)で削除するため、TTL を有効にする(--ttl -1)
 az cosmosdb sql container create \
     --resource-group $RESOURCE_GROUP_NAME \
     --account-name $COSMOS_ACCOUNT_NAME \
     --database-name $COSMOS_DB_NAME \
     --name $COSMOS_DOCS_CONTAINER_NAME \
-    --partition-key-path "/pk"
+    --partition-key-path "/pk" \
+    --idx @cosmos/docs-indexing-policy.json \
+    --ttl -1
 az cosmosdb sql container create \
     --resource-group $RESOURCE_GROUP_NAME \
     --account-name $COSMOS_ACCOUNT_NAME \
     --database-name $COSMOS_DB_NAME \
     --name $COSMOS_GROUPS_CONTAINER_NAME \
-    --partition-key-path "/pk"
+    --partition-key-path "/pk" \
+    --idx @cosmos/groups-indexing-policy.json
 az cosmosdb sql container create \
     --resource-group $RESOURCE_GROUP_NAME \
     --account-name $COSMOS_ACCOUNT_NAME \
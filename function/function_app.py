@@ -1,15 +1,22 @@
 import azure.functions as func
 import os
+import re
 import json
+import time
 import logging
-from collections import defaultdict
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils.blob import BlobContainer
 from utils.search import AISearchClient
 from utils.cosmos import CosmosContainer
-from utils.chunking import chunk_content
+from utils.chunking import chunk_content, chunk_content_by_tokens, count_tokens
+from utils.context_packing import pack_retrieved_docs
 from utils.document_intelligence import DocumentReader
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 from utils.openai import EmbeddingsClient, ChatCompletionClient
+from utils.embedding_cache import EmbeddingCache
+from utils.progress import ProgressChannel
+from utils.indexing import DocumentIndexer
 
 app = func.FunctionApp()
 
@@ -24,22 +31,69 @@ blob_container = BlobContainer()
 # Azure Cosmos DB にアクセスするためのインスタンスを生成する
 AZURE_COSMOS_DB_NAME = os.getenv("AZURE_COSMOS_DB_NAME")
 AZURE_COSMOS_DOCS_CONTAINER_NAME = os.getenv("AZURE_COSMOS_DOCS_CONTAINER_NAME")
-docs_cosmos_container = CosmosContainer(container_name=AZURE_COSMOS_DOCS_CONTAINER_NAME)
+# (解析結果やコンテンツなどサイズの大きいフィールドは Azure Blob Storage に退避し、必要な処理でのみ読み込む)
+# (アイテムは所有ユーザのIDをパーティションキーとして格納する)
+docs_cosmos_container = CosmosContainer(
+    container_name=AZURE_COSMOS_DOCS_CONTAINER_NAME,
+    blob_container=blob_container,
+    offload_fields=["content", "analysis_result", "chapter_contents"],
+    partition_key_field="owner_user_id",
+)
+
+# ドキュメント生成の進捗イベントを Web アプリに通知するためのインスタンスを生成する
+progress_channel = ProgressChannel(blob_container)
 
 # Azure OpenAI Service にアクセスするためのインスタンスを生成する
+# (同じテキストの埋め込みはメモリと Azure Blob Storage にキャッシュして再利用する)
+embedding_cache_enabled = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+embedding_cache = EmbeddingCache(blob_container) if embedding_cache_enabled else None
 chat_client = ChatCompletionClient()
-embed_client = EmbeddingsClient()
+embed_client = EmbeddingsClient(cache=embedding_cache)
 
 # Azure AI Search にアクセスするためのインスタンスを生成する
 search_client = AISearchClient()
 
 # Azure Document Intelligence でドキュメントを解析するためのインスタンスを生成する
-doc_reader = DocumentReader()
+# (同じ内容のファイルの解析結果は Azure Blob Storage にキャッシュして再利用する)
+ocr_cache_enabled = os.getenv("OCR_CACHE_ENABLED", "true").lower() == "true"
+doc_reader = DocumentReader(cache_container=blob_container if ocr_cache_enabled else None)
 
 # チャンク分割の設定を取得する
-chunk_size = os.getenv("CHUNK_SIZE", 4096)
-chunk_overlap_rate = os.getenv("CHUNK_OVERLAP_RATE", 0.0)
+chunk_size = int(os.getenv("CHUNK_SIZE", 4096))
+chunk_overlap_rate = float(os.getenv("CHUNK_OVERLAP_RATE", 0.0))
 chunk_overlap_strategy = os.getenv("CHUNK_OVERLAP_STRATEGY", "NONE")
+chunk_method = os.getenv("CHUNK_METHOD", "TEXT")  # TEXT | TOKEN
+
+# Azure AI Search へ一度にアップロードするチャンク数を取得する
+index_upload_batch_size = int(os.getenv("INDEX_UPLOAD_BATCH_SIZE", 100))
+
+# Azure AI Search のインデックスにチャンクを格納するためのインスタンスを生成する
+document_indexer = DocumentIndexer(search_client, embed_client, upload_batch_size=index_upload_batch_size)
+
+# ドキュメント生成時に並列で生成する章の数を取得する
+generation_concurrency = int(os.getenv("GENERATION_CONCURRENCY", 1))
+
+# ドキュメント生成時の関連ドキュメントの検索方法を取得する
+# (HYBRID の場合はキーワード検索とベクトル検索を組み合わせ、必要に応じてセマンティックランカーで再ランク付けする)
+search_method = os.getenv("SEARCH_METHOD", "HYBRID")  # HYBRID | TEXT
+search_semantic_rerank = os.getenv("SEARCH_SEMANTIC_RERANK", "false").lower() == "true"
+search_min_reranker_score = float(os.getenv("SEARCH_MIN_RERANKER_SCORE")) if os.getenv("SEARCH_MIN_RERANKER_SCORE") else None
+
+# ドキュメント生成時に検索する関連ドキュメント(チャンク)の数と、プロンプトに埋め込むトークン数の上限を取得する
+# (上限はモデルのコンテキストウィンドウのサイズからプロンプトの他の部分を差し引いた値を超えないようにする)
+retrieval_top = int(os.getenv("RETRIEVAL_TOP", 10))
+retrieved_docs_max_tokens = int(os.getenv("RETRIEVED_DOCS_MAX_TOKENS", 16000))
+chat_context_window = int(os.getenv("CHAT_CONTEXT_WINDOW", 128000))
+prompt_overhead_tokens = 500
+
+# ドキュメント生成時に、生成途中の章のテキストを進捗イベントとして発行する間隔(秒)を取得する
+generation_progress_interval = float(os.getenv("GENERATION_PROGRESS_INTERVAL", 1.0))
+
+# リファレンスドキュメントから並列で抽出する章の数を取得する
+chapter_extraction_concurrency = int(os.getenv("CHAPTER_EXTRACTION_CONCURRENCY", 4))
+
+# リファレンスドキュメントから章のコンテンツを抽出する方法を取得する
+chapter_extraction_method = os.getenv("CHAPTER_EXTRACTION_METHOD", "HEADING")  # HEADING | LLM
 
 # ドキュメントのタイプおよび処理ステータスで呼び出す関数を定義する
 process_functions_map = {
@@ -80,16 +134,23 @@ def process_documents(docs: func.DocumentList):
             func_name = process_functions_map[doc_type][doc_status]
 
             # 関数を実行する
-            doc = docs_cosmos_container.get_item(doc["id"])
+            doc = docs_cosmos_container.get_item(doc["id"], partition_key=docs_cosmos_container.get_partition_key(doc))
             doc = eval(func_name)(doc)
 
             # 関数実行により更新されたドキュメントを Cosmos DB に格納する(Update処理)
             docs_cosmos_container.upsert_item(doc)
 
+            # 生成の終了を表す進捗イベントは、Cosmos DB にステータスを保存した後に発行する
+            # (イベントを受信した画面からのダウンロードなどの操作時に、ステータスが更新済みであるようにするため)
+            if doc_type == "generated":
+                __publish_progress(doc["id"], {"type": "status", "status": doc["status"]})
+
         except Exception as e:
             logger.error(f"Failed to process document: {e}")
             doc["status"] = "failed"
             docs_cosmos_container.upsert_item(doc)
+            if doc.get("type") == "generated":
+                __publish_progress(doc["id"], {"type": "status", "status": "failed"})
 
 
 # ドキュメントファイルからテキストを抽出する
@@ -101,9 +162,15 @@ def __extract_contents(doc: dict) -> dict:
     sas_url = blob_container.get_url_with_sas(doc_id)
     logger.info(f"generated sas url: {sas_url}")
 
+    # 解析結果のキャッシュを参照するために、アップロード時に計算したドキュメントの内容のハッシュ値を取得する
+    # (ハッシュ値の計算後に Blob が上書きされている場合や、ハッシュ値が記録されていない場合はキャッシュを使用しない)
+    content_hash = None
+    if ocr_cache_enabled and doc.get("content_sha256") and blob_container.get_etag(doc_id) == doc.get("content_etag"):
+        content_hash = doc["content_sha256"]
+
     # Azure AI Document Intelligence でドキュメントを解析する(テキスト抽出)
     high_resolution = True if file_extention in ["pdf"] else False
-    analysis_result = doc_reader.get_ocr_result_by_url(sas_url, high_resolution=high_resolution)
+    analysis_result = doc_reader.get_ocr_result_by_url(sas_url, high_resolution=high_resolution, content_hash=content_hash)
     content = doc_reader.get_content_from_ocr_result(analysis_result)
     logger.info(f"extracted content: {doc_id} ({len(content)} characters)")
 
@@ -116,7 +183,7 @@ def __extract_contents(doc: dict) -> dict:
 
 # ドキュメントのコンテンツ(文章)から章のタイトル一覧を抽出する
 def __extract_chapter_titles(doc: dict) -> dict:
-    content = doc["content"]
+    content = docs_cosmos_container.load_field(doc, "content")
     logger.info(f"extract chapter titles: {doc['id']}")
 
     # ドキュメントのコンテンツ(文章)から章のタイトル一覧を抽出する
@@ -158,15 +225,63 @@ def __extract_chapter_titles(doc: dict) -> dict:
 
 # ドキュメントのコンテンツ(文章)から指定した章のコンテンツ(文書)を抽出する
 def __extract_chapter_contents(doc: dict) -> dict:
-    content = doc["content"]
+    content = docs_cosmos_container.load_field(doc, "content")
     chapter_titles = doc["chapter_titles"]
 
-    # リファレンスドキュメントから各チャプターのテキストを抽出する
-    chapter_contents = []
+    # 見出しの位置を特定できた章は、ドキュメントのコンテンツから章の範囲を直接切り出す
+    if chapter_extraction_method == "HEADING":
+        chapter_contents = __slice_chapter_contents(content, chapter_titles)
+    else:
+        chapter_contents = [None] * len(chapter_titles)
+
+    # 切り出せなかった章のみ、LLM で抽出する
+    missing_indexes = [i for i, c in enumerate(chapter_contents) if c is None]
+    logger.info(f"extract chapter contents: {len(chapter_titles) - len(missing_indexes)} sliced, {len(missing_indexes)} by LLM")
+    if len(missing_indexes) > 0:
+        missing_titles = [chapter_titles[i] for i in missing_indexes]
+        extracted_contents = __extract_chapter_contents_by_llm(content, chapter_titles, missing_titles)
+        for i, chapter_content in zip(missing_indexes, extracted_contents):
+            chapter_contents[i] = chapter_content
+
+    # ドキュメントのメタデータを更新したものを返す
+    doc["status"] = "processed"
+    doc["chapter_contents"] = chapter_contents
+    return doc
+
+
+# ドキュメントのコンテンツ(文章)に含まれる見出し(<h1>, <h2>)の位置をもとに、各章のコンテンツを切り出す
+# 章タイトルに一致する見出しが見つからない章、および次の章の開始位置が分からない章は None とする
+def __slice_chapter_contents(content: str, chapter_titles: list[str]) -> list[str]:
+    headings = doc_reader.get_headings_from_content(content)
+
+    # 各章タイトルに一致する見出しを、章の順序に沿ってドキュメントの先頭から探す
+    offsets = []
+    heading_index = 0
     for chapter_title in chapter_titles:
-        logger.info(f"extract chapter content: {chapter_title}")
+        normalized_title = doc_reader.normalize_heading(chapter_title)
+        offset = None
+        for i in range(heading_index, len(headings)):
+            if normalized_title and headings[i]["normalized_content"] == normalized_title:
+                offset = headings[i]["offset"]
+                heading_index = i + 1
+                break
+        offsets.append(offset)
+
+    # 章の見出しから次の章の見出しの直前まで(最後の章はドキュメントの末尾まで)を切り出す
+    chapter_contents = []
+    for i, offset in enumerate(offsets):
+        end = offsets[i + 1] if i + 1 < len(offsets) else len(content)
+        if offset is None or end is None:
+            chapter_contents.append(None)
+        else:
+            chapter_contents.append(content[offset:end].strip())
+
+    return chapter_contents
 
-        system_message_template = """
+
+# ドキュメントのコンテンツ(文章)から指定した複数の章のコンテンツ(文書)を LLM で並列に抽出する
+def __extract_chapter_contents_by_llm(content: str, chapter_titles: list[str], target_titles: list[str]) -> list[str]:
+    system_message_template = """
 - 以下の「対象のドキュメント」のうち、ユーザが指定した「対象の章」の箇所の文章のみを抽出してください。
 - ユーザは「対象の章」を章のタイトルで指定します。
 - 今回の実行だけでなく、全体の実行で抽出する章タイトルの一覧は「章のタイトル一覧」で指定されています
@@ -178,9 +293,19 @@ def __extract_chapter_contents(doc: dict) -> dict:
 
 # 対象のドキュメント
 {content}
-        """.strip()
+    """.strip()
+    system_message = system_message_template.format(content=content, chapter_titles="\n".join([f"- {t}" for t in chapter_titles]))
+
+    # 各チャプターのテキストを並列に抽出する(結果は target_titles の順序通りに並ぶ)
+    with ThreadPoolExecutor(max_workers=chapter_extraction_concurrency) as executor:
+        return list(executor.map(lambda t: __extract_chapter_content(t, system_message), target_titles))
+
 
-        user_message_template = """
+# ドキュメントのコンテンツ(文章)から指定した章のコンテンツ(文書)を LLM で抽出する
+def __extract_chapter_content(chapter_title: str, system_message: str) -> str:
+    logger.info(f"extract chapter content: {chapter_title}")
+
+    user_message_template = """
 「対象の章のタイトル」で指定した章の箇所の文章を抽出して出力してください。
 抽出した文章は、「出力フォーマット」通りのJSON形式で出力してください。
 
@@ -191,43 +316,28 @@ def __extract_chapter_contents(doc: dict) -> dict:
 {{
     "content": "Extracted Content"
 }}
-        """.strip()
-
-        system_message = system_message_template.format(content=content, chapter_titles="\n".join([f"- {t}" for t in chapter_titles]))
-        user_message = user_message_template.format(chapter_title=chapter_title)
-        messages = chat_client.create_message(system_message, user_message)
-        completion = chat_client.get_completion(messages, json_format=True)
-        chapter_content = json.loads(completion)["content"]
-        chapter_contents.append(chapter_content)
+    """.strip()
 
-    # ドキュメントのメタデータを更新したものを返す
-    doc["status"] = "processed"
-    doc["chapter_contents"] = chapter_contents
-    return doc
+    user_message = user_message_template.format(chapter_title=chapter_title)
+    messages = chat_client.create_message(system_message, user_message)
+    completion = chat_client.get_completion(messages, json_format=True)
+    return json.loads(completion)["content"]
 
 
 # ドキュメントのコンテンツ(文章)をチャンク分割して Azure AI Search のインデックスに格納する
 def __index_document(doc: dict) -> dict:
     doc_id = doc["id"]
     src_group_id = doc["group_id"]
-    content = doc["content"]
+    content = docs_cosmos_container.load_field(doc, "content")
 
     # チャンク分割をする
-    chunks = chunk_content(content, chunk_size, chunk_overlap_rate, chunk_overlap_strategy)
-
-    # Azure AI Search のインデックスに格納する
-    index_docs = [
-        {
-            "id": doc_id,
-            "sourceGroupId": src_group_id,
-            "sourceDocumentId": doc_id,
-            "chunkNo": i,
-            "content": chunk,
-            "contentVector": embed_client.get_embeds(chunk),
-        }
-        for i, chunk in enumerate(chunks)
-    ]
-    search_client.register_documents(index_docs)
+    chunk_func = chunk_content_by_tokens if chunk_method == "TOKEN" else chunk_content
+    chunks = chunk_func(content, chunk_size, chunk_overlap_rate, chunk_overlap_strategy)
+
+    # 追加・変更されたチャンクのみ埋め込みを取得して Azure AI Search のインデックスに格納し、不要になったチャンクを削除する
+    document_indexer.index_chunks(doc_id, src_group_id, chunks)
+    if embedding_cache:
+        logger.info(f"embedding cache stats: {embedding_cache.get_stats()}")
 
     # ドキュメントのステータスを更新する
     doc["status"] = "processed"
@@ -237,43 +347,56 @@ def __index_document(doc: dict) -> dict:
 
 # ドキュメントの生成リクエストに応じて、ドキュメントコンテンツを生成する
 def __generate_document(doc: dict) -> dict:
+    doc_id = doc["id"]
     try:
         ref_doc_id = doc["reference_doc_id"]
         src_group_id = doc["source_group_id"]
 
         # リファレンスドキュメントのコンテンツを取得する
-        ref_doc = docs_cosmos_container.get_item(ref_doc_id)
+        # (リファレンスドキュメントは生成ドキュメントと同じユーザが所有するため、同じパーティションから読み込む)
+        ref_doc = docs_cosmos_container.get_item(ref_doc_id, partition_key=docs_cosmos_container.get_partition_key(doc))
         chapter_titles = ref_doc["chapter_titles"]
-        chapter_contents = ref_doc["chapter_contents"]
+        chapter_contents = docs_cosmos_container.load_field(ref_doc, "chapter_contents")
 
         # 生成を開始したステータスに更新する
         doc["status"] = "generating"
         doc["chapter_titles"] = chapter_titles
         doc["generated_contents"] = []
         docs_cosmos_container.upsert_item(doc)
-
-        # 各章ごとにコンテンツを生成する
-        generated_contents = []
-        for chapter_title, chapter_content in zip(chapter_titles, chapter_contents):
-            logger.info(f"generating chapter content: {chapter_title}")
-
-            # 関連ドキュメントを検索する
-            query = chapter_title
-            docs = search_client.search(query, top=10, filter=f"sourceGroupId eq '{src_group_id}'")
-            retrieved_documents = __generate_retrieved_docs_content(docs)
-
-            # 章コンテンツを生成する
-            generated_content = __generate_chapter_content(chapter_title, chapter_content, retrieved_documents)
-            generated_contents.append(generated_content)
-            logger.info(f"generated content: {len(generated_content)} characters")
-
-            # 章コンテンツの生成を行うたびに Cosmos DB のアイテムを更新する
-            doc["status"] = "generating"
-            doc["chapter_titles"] = chapter_titles
-            doc["generated_contents"] = generated_contents
-            docs_cosmos_container.upsert_item(doc)
-
-        # ドキュメントのステータスを更新する
+        __reset_progress(doc_id)
+        __publish_progress(doc_id, {"type": "status", "status": "generating", "chapter_titles": chapter_titles})
+
+        # 各章ごとにコンテンツを生成する(最大 generation_concurrency 章を並列に生成する)
+        generated_contents = [None] * len(chapter_titles)
+        published_count = 0
+        with ThreadPoolExecutor(max_workers=generation_concurrency) as executor:
+            futures = {
+                executor.submit(__generate_chapter, chapter_title, chapter_content, src_group_id, __create_delta_publisher(doc_id, i)): i
+                for i, (chapter_title, chapter_content) in enumerate(zip(chapter_titles, chapter_contents))
+            }
+            try:
+                for future in as_completed(futures):
+                    i = futures[future]
+                    generated_contents[i] = future.result()
+                    __publish_progress(doc_id, {"type": "chapter", "index": i, "content": generated_contents[i]})
+
+                    # 先頭から連続して生成が完了した章が増えるたびに Cosmos DB のアイテムを章の順序通りに更新する
+                    completed_count = published_count
+                    while completed_count < len(generated_contents) and generated_contents[completed_count] is not None:
+                        completed_count += 1
+                    if completed_count > published_count:
+                        published_count = completed_count
+                        doc["status"] = "generating"
+                        doc["chapter_titles"] = chapter_titles
+                        doc["generated_contents"] = generated_contents[:published_count]
+                        docs_cosmos_container.upsert_item(doc)
+            except Exception:
+                # いずれかの章の生成に失敗した場合は、未着手の章の生成を取り消す
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # ドキュメントのステータスを更新する(終了の進捗イベントは Cosmos DB に保存した後に発行する)
         doc["status"] = "processed"
         return doc
 
@@ -283,34 +406,73 @@ def __generate_document(doc: dict) -> dict:
         return doc
 
 
-# 検索で取得した検索ドキュメントからプロンプトに埋め込むためのテキストを作成する
-def __generate_retrieved_docs_content(docs: list[dict]) -> str:
+# 生成途中の章のテキストの差分を、進捗イベントとして発行する関数を作成する
+def __create_delta_publisher(doc_id: str, chapter_index: int) -> Callable[[str], None]:
+    return lambda delta: __publish_progress(doc_id, {"type": "delta", "index": chapter_index, "content": delta})
 
-    # ドキュメントごとにまとめる
-    docs_groups = defaultdict(list)
-    for doc in docs:
-        docs_groups[doc["sourceDocumentId"]].append(doc)
-
-    # 各ドキュメントごとにコンテンツをまとめてプロンプトに埋め込む用のテキストを生成
-    content = ""
-    for i, src_doc_id in enumerate(docs_groups.keys()):
-        content += f"## 参考ドキュメント {i+1}"
-        docs = docs_groups[src_doc_id]
-        docs = sorted(docs, key=lambda x: x["chunkNo"])
-        last_chunk_no = -1
-        for doc in docs:
-            if doc["chunkNo"] != last_chunk_no + 1:
-                content += "\n\n...\n"
-            content += "\n" + doc["content"]
-            last_chunk_no = doc["chunkNo"]
-        content += "\n\n"
-    content = content.strip()
-
-    return content
+
+# 進捗イベントを発行する
+# (進捗イベントは画面表示のための補助的な情報のため、発行に失敗してもドキュメントの生成は継続する)
+def __publish_progress(doc_id: str, event: dict):
+    try:
+        progress_channel.publish(doc_id, event)
+    except Exception as e:
+        logger.warning(f"Failed to publish progress event: {doc_id}, {event['type']}, {e}")
+
+
+# 以前の生成で発行した進捗イベントを削除する
+def __reset_progress(doc_id: str):
+    try:
+        progress_channel.reset(doc_id)
+    except Exception as e:
+        logger.warning(f"Failed to reset progress events: {doc_id}, {e}")
+
+
+# 関連ドキュメントを検索し、指定した章のコンテンツを生成する
+def __generate_chapter(chapter_title: str, chapter_content: str, src_group_id: str, on_delta: Callable[[str], None] = None) -> str:
+    logger.info(f"generating chapter content: {chapter_title}")
+
+    # 関連ドキュメントを検索する
+    query = chapter_title
+    filter = f"sourceGroupId eq '{src_group_id}'"
+    if search_method == "HYBRID":
+        # クエリの埋め込みは埋め込みキャッシュを経由して取得する(同じ章タイトルでの再生成時は API を呼び出さない)
+        query_vector = embed_client.get_embeds_batch([query])[0]
+        docs = search_client.hybrid_search(
+            query,
+            query_vector,
+            filter=filter,
+            top=retrieval_top,
+            semantic=search_semantic_rerank,
+            min_reranker_score=search_min_reranker_score,
+        )
+    else:
+        docs = search_client.search(query, top=retrieval_top, filter=filter)
+    max_tokens = __calc_retrieved_docs_max_tokens(chapter_title, chapter_content)
+    retrieved_documents = __generate_retrieved_docs_content(docs, max_tokens)
+
+    # 章コンテンツを生成する
+    generated_content = __generate_chapter_content(chapter_title, chapter_content, retrieved_documents, on_delta)
+    logger.info(f"generated content: {len(generated_content)} characters")
+    return generated_content
+
+
+# 検索で取得した検索ドキュメントから、トークン数の上限に収まるようにプロンプトに埋め込むためのテキストを作成する
+def __generate_retrieved_docs_content(docs: list[dict], max_tokens: int) -> str:
+    return pack_retrieved_docs(docs, max_tokens)
+
+
+# プロンプトに埋め込む検索ドキュメントのトークン数の上限を計算する
+# (モデルのコンテキストウィンドウから、章タイトル・参考章コンテンツ・指示文・生成する最大トークン数の分を差し引く)
+def __calc_retrieved_docs_max_tokens(chapter_title: str, chapter_content: str) -> int:
+    prompt_tokens = count_tokens(chapter_title) + count_tokens(chapter_content) + prompt_overhead_tokens
+    available_tokens = chat_context_window - prompt_tokens - chat_client.max_tokens
+    return max(0, min(retrieved_docs_max_tokens, available_tokens))
 
 
 # 与えられた章タイトル、参考章コンテンツ、生成のためのドキュメントを使用して、章コンテンツ(文章)を生成する
-def __generate_chapter_content(chapter_title: str, chapter_content: str, retrieved_documents) -> str:
+# (生成途中のテキストは generation_progress_interval 秒ごとに、前回からの差分を on_delta に渡す)
+def __generate_chapter_content(chapter_title: str, chapter_content: str, retrieved_documents, on_delta: Callable[[str], None] = None) -> str:
 
     system_message = """
 - 与えられた「章のタイトル」から、「章の文章」を生成してください
@@ -343,6 +505,37 @@ def __generate_chapter_content(chapter_title: str, chapter_content: str, retriev
     )
 
     messages = chat_client.create_message(system_message, user_message)
-    completion = chat_client.get_completion(messages, json_format=True)
-    generated_content = json.loads(completion)["content"]
+    stream = chat_client.get_completion_stream(messages, json_format=True)
+    published_content = ""
+    published_at = time.monotonic()
+    for _ in stream:
+        if on_delta and time.monotonic() - published_at >= generation_progress_interval:
+            partial_content = __extract_partial_content(stream.content)
+            if len(partial_content) > len(published_content):
+                on_delta(partial_content[len(published_content) :])
+                published_content = partial_content
+            published_at = time.monotonic()
+    logger.info(f"chapter completion: time to first token {stream.time_to_first_token}s, {stream.tokens_per_second} tokens/s")
+
+    generated_content = json.loads(stream.content)["content"]
     return generated_content
+
+
+# 生成途中の JSON 形式の Completion から、"content" の値(文字列)のうち生成済みの部分を取り出す
+def __extract_partial_content(completion: str) -> str:
+    match = re.search(r'"content"\s*:\s*"', completion)
+    if not match:
+        return ""
+    try:
+        return json.decoder.scanstring(completion, match.end())[0]
+    except json.JSONDecodeError:
+        pass
+
+    # 文字列が閉じていない場合は、末尾の不完全なエスケープシーケンスを取り除いてから閉じてデコードする
+    value = completion[match.end() :]
+    for end in range(len(value), max(len(value) - 6, -1), -1):
+        try:
+            return json.loads(f'"{value[:end]}"')
+        except json.JSONDecodeError:
+            continue
+    return ""
@@ -1,9 +1,40 @@
 import re
+import regex
+import bisect
 import tiktoken
+from itertools import accumulate
+from functools import lru_cache
 
 # TikTokenの初期化
 tiktoken_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
+# TikToken がトークン化の前に文字列を事前分割する際の正規表現
+# (トークン数は事前分割された各ピースのトークン数の合計となる)
+tiktoken_pattern = regex.compile(tiktoken_encoding._pat_str)
+
+
+# トークン数を計算済みのテキスト
+# テキストを TikToken の事前分割単位(ピース)ごとに保持し、各ピースのトークン数を記録する
+class TokenizedText:
+
+    def __init__(self, pieces: list[str] = None, tokens: list[int] = None):
+        self.pieces = pieces or []
+        self.tokens = tokens or []
+        self.total = sum(self.tokens)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.pieces)
+
+    def copy(self):
+        return TokenizedText(list(self.pieces), list(self.tokens))
+
+
+# 文字列のトークン数を計算する
+# (事前分割した各ピースのトークン数はキャッシュされるため、同じ文字列を含むテキストを繰り返し数える場合も高速に計算できる)
+def count_tokens(s: str) -> int:
+    return __tokenize(s).total
+
 
 # コンテンツをチャンクに分割する
 def chunk_content(
@@ -13,12 +44,13 @@ def chunk_content(
     overlap_type: str,  # PREPOST | PRE | POST | NONE
 ):
     # 全チャンクが最大サイズを超えなくなるまで H1, H2, Tableタグでチャンクを分割する
-    chunks = [content]
+    # (トークン数は各チャンクにつき一度だけ計算し、以降は計算済みの値を使用する)
+    chunks = [__tokenize(content)]
     for tag in ["h1", "h2", "table"]:
         staging_chunks = []
         for chunk in chunks:
-            if __calc_tokens(chunk) > max_chunk_token_size:
-                staging_chunks += __split_content_by_html_tag(chunk, tag)
+            if chunk.total > max_chunk_token_size:
+                staging_chunks += [__tokenize(c) for c in __split_content_by_html_tag(chunk.text, tag)]
             else:
                 staging_chunks.append(chunk)
         chunks = staging_chunks
@@ -27,8 +59,8 @@ def chunk_content(
     for tag in ["\n", "。", "、", " "]:
         staging_chunks = []
         for chunk in chunks:
-            if __calc_tokens(chunk) > max_chunk_token_size:
-                staging_chunks += __split_content_by_delimiter(chunk, tag)
+            if chunk.total > max_chunk_token_size:
+                staging_chunks += [__tokenize(c) for c in __split_content_by_delimiter(chunk.text, tag)]
             else:
                 staging_chunks.append(chunk)
         chunks = staging_chunks
@@ -39,6 +71,45 @@ def chunk_content(
     return chunks
 
 
+# コンテンツをトークン位置(オフセット)ベースでチャンクに分割する
+# ドキュメント全体を一度だけトークン化し、HTMLタグや区切り文字の位置をトークン位置に対応付けたうえで、
+# チャンクをトークン配列の (開始, 終了) 範囲として求め、最後に確定したチャンクのみを文字列に戻す
+# (chunk_content と異なり、最初のタグより前の文章や連続する区切り文字も欠落させずにチャンクに含める)
+def chunk_content_by_tokens(
+    content: str,
+    max_chunk_token_size: int,  # ex) 4096
+    overlap_token_rate: float,  # ex) 0.1
+    overlap_type: str,  # PREPOST | PRE | POST | NONE
+):
+    # ドキュメント全体をトークン化し、全トークン数が最大チャンクトークン数以下の場合はそのまま返す
+    tokens = tiktoken_encoding.encode(content)
+    if len(tokens) <= max_chunk_token_size:
+        return [content]
+
+    # 各トークンの開始位置(UTF-8 でのバイト位置)を求める
+    content_bytes = content.encode("utf-8")
+    token_offsets = [0] + list(accumulate(len(b) for b in tiktoken_encoding.decode_tokens_bytes(tokens)))
+
+    # 全チャンクが最大サイズを超えなくなるまで H1, H2, Tableタグ、改行、句点、読点、スペースの位置で分割する
+    segments = [(0, len(tokens))]
+    boundary_patterns = [(f"<{tag}>", False) for tag in ["h1", "h2", "table"]]
+    boundary_patterns += [(delimiter, True) for delimiter in ["\n", "。", "、", " "]]
+    for pattern, after in boundary_patterns:
+        boundaries = __find_token_boundaries(content_bytes, token_offsets, pattern, after)
+        staging_segments = []
+        for start, end in segments:
+            if end - start > max_chunk_token_size:
+                cuts = boundaries[bisect.bisect_right(boundaries, start) : bisect.bisect_left(boundaries, end)]
+                staging_segments += list(zip([start] + cuts, cuts + [end]))
+            else:
+                staging_segments.append((start, end))
+        segments = staging_segments
+
+    # 分割した範囲を定義したチャンクサイズとオーバラップ設定に合わせて結合し、文字列に戻す
+    ranges = __merge_token_ranges(segments, max_chunk_token_size, overlap_token_rate, overlap_type)
+    return [content_bytes[token_offsets[start] : token_offsets[end]].decode("utf-8") for start, end in ranges]
+
+
 # 指定したHTMLタグでコンテンツを分割する
 def __split_content_by_html_tag(content, html_tag):
 
@@ -80,13 +151,15 @@ def __split_content_by_delimiter(content, delimiter):
 
 
 # 分割したチャンク同士を指定した chunk_token_size に合わせて適切なサイズに結合する
-def __merge_chunks(chunks, max_chunk_token_size, overlap_token_rate, overlap_type="PREPOST"):
+def __merge_chunks(chunks: list[TokenizedText], max_chunk_token_size, overlap_token_rate, overlap_type="PREPOST"):
 
     # 入力されたチャンクを全て結合したもののトークン数が最大チャンクトークン数以下の場合は全て結合して返す
     # (無駄にオーバラップ処理を行わないための処理)
-    total_tokens = __calc_tokens("".join(chunks))
-    if total_tokens <= max_chunk_token_size:
-        return ["".join(chunks)]
+    total_chunk = TokenizedText()
+    for chunk in chunks:
+        __append_tokenized(total_chunk, chunk)
+    if total_chunk.total <= max_chunk_token_size:
+        return [total_chunk.text]
 
     # オーバラップ設定に合わせてオーバラップトークン数を計算する
     overlap_token_size = int(max_chunk_token_size * overlap_token_rate)
@@ -100,55 +173,174 @@ def __merge_chunks(chunks, max_chunk_token_size, overlap_token_rate, overlap_typ
         chunk_token_size = max_chunk_token_size
 
     processed_chunks = []
-    staging_chunk = ""
-    pre_overlap_chunk = ""
-    post_overlap_chunk = ""
+    staging_chunk = TokenizedText()
+    pre_overlap_chunk = TokenizedText()
+    post_overlap_chunk = TokenizedText()
     for i in range(0, len(chunks)):
-        # ステージングチャンクと処理対象のチャンクのトークン数を計算する
+        # ステージングチャンクと処理対象のチャンクのトークン数は計算済みの値を使用する
         chunk = chunks[i]
-        staging_chunk_tokens = __calc_tokens(staging_chunk)
-        chunk_tokens = __calc_tokens(chunk)
 
         # 指定トークン数を超える場合は、前後オーバラップ分を作成＆付与してチャンクとして確定する
-        if staging_chunk_tokens + chunk_tokens > chunk_token_size:
+        if staging_chunk.total + chunk.total > chunk_token_size:
 
             # 後オーバラップ分を作成
             if overlap_type == "POST" or overlap_type == "PREPOST":
-                post_overlap_chunk = ""
+                post_overlap_chunk = TokenizedText()
                 for j in range(i, len(chunks)):
                     overlap_chunk = chunks[j]
-                    overlap_chunk_tokens = __calc_tokens(overlap_chunk)
-                    post_overlap_chunk_tokens = __calc_tokens(post_overlap_chunk)
-                    if overlap_chunk_tokens + post_overlap_chunk_tokens > overlap_token_size:
+                    if overlap_chunk.total + post_overlap_chunk.total > overlap_token_size:
                         break
-                    post_overlap_chunk += overlap_chunk
+                    __append_tokenized(post_overlap_chunk, overlap_chunk)
 
             # ステージングチャンクに前後オーバラップ分を付与してチャンクとして確定する
-            processed_chunk = pre_overlap_chunk + staging_chunk + post_overlap_chunk
+            processed_chunk = pre_overlap_chunk.text + staging_chunk.text + post_overlap_chunk.text
             processed_chunks.append(processed_chunk)
-            staging_chunk = chunk
+            staging_chunk = chunk.copy()
 
             # 前オーバラップ分を作成
             if overlap_type == "PRE" or overlap_type == "PREPOST":
-                pre_overlap_chunk = ""
+                pre_overlap_chunk = TokenizedText()
                 for j in range(i - 1, 0, -1):
                     overlap_chunk = chunks[j]
-                    overlap_chunk_tokens = __calc_tokens(overlap_chunk)
-                    pre_overlap_chunk_tokens = __calc_tokens(pre_overlap_chunk)
-                    if overlap_chunk_tokens + pre_overlap_chunk_tokens > overlap_token_size:
+                    if overlap_chunk.total + pre_overlap_chunk.total > overlap_token_size:
                         break
-                    pre_overlap_chunk = overlap_chunk + pre_overlap_chunk
+                    pre_overlap_chunk = __append_tokenized(overlap_chunk.copy(), pre_overlap_chunk)
         else:
             # 指定トークン数を超えない場合は、ステージングチャンクに追加する
-            staging_chunk += chunk
+            __append_tokenized(staging_chunk, chunk)
 
     # 最後のチャンクに前オーバラップ分を付与してチャンクとして確定する
-    processed_chunk = pre_overlap_chunk + staging_chunk
+    processed_chunk = pre_overlap_chunk.text + staging_chunk.text
     processed_chunks.append(processed_chunk)
 
     return processed_chunks
 
 
-# 指定した文字列のトークン数を計算する
-def __calc_tokens(s):
-    return len(tiktoken_encoding.encode(s))
+# 分割したトークン範囲同士を指定した chunk_token_size に合わせて適切なサイズに結合する
+# (トークン数は範囲の長さで求まるため、文字列の結合やトークン数の再計算は行わない)
+def __merge_token_ranges(segments: list[tuple[int, int]], max_chunk_token_size, overlap_token_rate, overlap_type="PREPOST"):
+
+    # オーバラップ設定に合わせてオーバラップトークン数を計算する
+    overlap_token_size = int(max_chunk_token_size * overlap_token_rate)
+
+    # 最大チャンクサイズをオーバラップ設定に合わせて調整する
+    if overlap_type == "PRE" or overlap_type == "POST":
+        chunk_token_size = max_chunk_token_size - overlap_token_size
+    elif overlap_type == "PREPOST":
+        chunk_token_size = max_chunk_token_size - overlap_token_size * 2
+    else:
+        chunk_token_size = max_chunk_token_size
+
+    processed_ranges = []
+    staging_tokens = 0
+    pre_overlap_start = segments[0][0]
+    for i in range(0, len(segments)):
+        start, end = segments[i]
+
+        # 指定トークン数を超える場合は、前後オーバラップ分を付与した範囲をチャンクとして確定する
+        if staging_tokens > 0 and staging_tokens + (end - start) > chunk_token_size:
+
+            # 後オーバラップ分の終了位置を求める
+            post_overlap_end = start
+            if overlap_type == "POST" or overlap_type == "PREPOST":
+                overlap_tokens = 0
+                for j in range(i, len(segments)):
+                    overlap_start, overlap_end = segments[j]
+                    if (overlap_end - overlap_start) + overlap_tokens > overlap_token_size:
+                        break
+                    overlap_tokens += overlap_end - overlap_start
+                    post_overlap_end = overlap_end
+
+            processed_ranges.append((pre_overlap_start, post_overlap_end))
+            staging_tokens = end - start
+
+            # 前オーバラップ分の開始位置を求める
+            pre_overlap_start = start
+            if overlap_type == "PRE" or overlap_type == "PREPOST":
+                overlap_tokens = 0
+                for j in range(i - 1, 0, -1):
+                    overlap_start, overlap_end = segments[j]
+                    if (overlap_end - overlap_start) + overlap_tokens > overlap_token_size:
+                        break
+                    overlap_tokens += overlap_end - overlap_start
+                    pre_overlap_start = overlap_start
+        else:
+            # 指定トークン数を超えない場合は、ステージング範囲に追加する
+            staging_tokens += end - start
+
+    # 最後の範囲に前オーバラップ分を付与してチャンクとして確定する
+    processed_ranges.append((pre_overlap_start, segments[-1][1]))
+
+    return processed_ranges
+
+
+# 指定した文字列(HTMLタグ・区切り文字)の位置に対応するトークン位置の一覧を返す
+# after=True の場合は区切り文字の直後、False の場合は文字列の直前を分割位置とする
+def __find_token_boundaries(content_bytes: bytes, token_offsets: list[int], s: str, after: bool) -> list[int]:
+    boundaries = []
+    for m in re.finditer(re.escape(s.encode("utf-8")), content_bytes):
+        offset = m.end() if after else m.start()
+
+        # 分割位置がトークンの途中の場合は、文字の途中で分割しない次のトークンの開始位置に合わせる
+        index = bisect.bisect_left(token_offsets, offset)
+        while index < len(token_offsets) - 1 and (content_bytes[token_offsets[index]] & 0xC0) == 0x80:
+            index += 1
+        if 0 < index < len(token_offsets) - 1 and (not boundaries or boundaries[-1] < index):
+            boundaries.append(index)
+
+    return boundaries
+
+
+# 指定した文字列を事前分割し、ピースごとのトークン数を計算する
+def __tokenize(s: str) -> TokenizedText:
+    pieces = tiktoken_pattern.findall(s)
+    return TokenizedText(pieces, [__calc_piece_tokens(p) for p in pieces])
+
+
+# トークン数を計算済みのテキストの末尾に別のテキストを結合する(left を更新して返す)
+# 結合によって事前分割の結果が変わり得るのは結合箇所の前後のみのため、その範囲だけを再分割する
+def __append_tokenized(left: TokenizedText, right: TokenizedText) -> TokenizedText:
+    if not right.pieces:
+        return left
+    if not left.pieces:
+        left.pieces.extend(right.pieces)
+        left.tokens.extend(right.tokens)
+        left.total += right.total
+        return left
+
+    # 後続の文字列によって分割結果が変わり得る末尾のピース(末尾の空白の連続とその直前のピース)から再分割する
+    k = len(left.pieces) - 1
+    while k > 0 and left.pieces[k].isspace():
+        k -= 1
+    k = max(k - 1, 0)
+    tail = "".join(left.pieces[k:])
+    left.total -= sum(left.tokens[k:])
+    del left.pieces[k:]
+    del left.tokens[k:]
+
+    # 再分割したピースの開始位置が right のピースの開始位置と一致したら、以降は right の分割結果をそのまま使う
+    j = 0
+    right_pos = len(tail)
+    for m in tiktoken_pattern.finditer(tail + right.text):
+        pos = m.start()
+        while j < len(right.pieces) and right_pos < pos:
+            right_pos += len(right.pieces[j])
+            j += 1
+        if right_pos == pos:
+            left.pieces.extend(right.pieces[j:])
+            left.tokens.extend(right.tokens[j:])
+            left.total += right.total - sum(right.tokens[:j])
+            return left
+        piece = m.group()
+        piece_tokens = __calc_piece_tokens(piece)
+        left.pieces.append(piece)
+        left.tokens.append(piece_tokens)
+        left.total += piece_tokens
+
+    return left
+
+
+# 事前分割されたピースのトークン数を計算する(同じピースは何度も出現するためキャッシュする)
+@lru_cache(maxsize=65536)
+def __calc_piece_tokens(piece: str) -> int:
+    return len(tiktoken_encoding._encode_single_piece(piece))
@@ -0,0 +1,74 @@
+from collections import defaultdict
+from utils.chunking import count_tokens
+
+# プロンプトに埋め込む際の区切り文字列
+DOC_HEADER_TEMPLATE = "## 参考ドキュメント {no}"
+GAP_SEPARATOR = "\n\n...\n\n"
+CHUNK_SEPARATOR = "\n"
+DOC_SEPARATOR = "\n\n"
+
+
+# 検索で取得したチャンクを、トークン数の上限に収まるようにプロンプトに埋め込むためのテキストにまとめる
+# - docs は検索スコアの高い順に並んでいるものとし、上位のチャンクから優先して採用する
+# - 同じチャンク、および同じ内容のチャンクは重複して埋め込まない
+# - 同じドキュメントのチャンクはチャンク番号順に並べ、連続するチャンクは区切りを入れずに結合する
+def pack_retrieved_docs(docs: list[dict], max_tokens: int) -> str:
+    chunks = __deduplicate_chunks(docs)
+
+    # 上位のチャンクから順に、上限を超えない範囲で採用する(上限を超えるチャンクは飛ばして次のチャンクを試す)
+    # 区切り文字列や見出しのトークン数も含めて見積もる
+    selected = []
+    selected_doc_ids = set()
+    total_tokens = 0
+    for chunk in chunks:
+        tokens = chunk["tokens"] + count_tokens(GAP_SEPARATOR)
+        if chunk["sourceDocumentId"] not in selected_doc_ids:
+            tokens += count_tokens(DOC_HEADER_TEMPLATE.format(no=len(selected_doc_ids) + 1) + DOC_SEPARATOR)
+        if total_tokens + tokens > max_tokens:
+            continue
+        selected.append(chunk)
+        selected_doc_ids.add(chunk["sourceDocumentId"])
+        total_tokens += tokens
+
+    # 結合によってトークン数が見積もりを上回った場合は、下位のチャンクから除外する
+    content = __format_chunks(selected)
+    while selected and count_tokens(content) > max_tokens:
+        selected.pop()
+        content = __format_chunks(selected)
+
+    return content
+
+
+# 同じチャンク(ドキュメントIDとチャンク番号が同じもの)と、同じ内容のチャンクを除外し、各チャンクのトークン数を計算する
+def __deduplicate_chunks(docs: list[dict]) -> list[dict]:
+    chunks = []
+    seen_keys = set()
+    seen_contents = set()
+    for doc in docs:
+        key = (doc["sourceDocumentId"], doc["chunkNo"])
+        content = doc["content"].strip()
+        if key in seen_keys or content in seen_contents:
+            continue
+        seen_keys.add(key)
+        seen_contents.add(content)
+        chunks.append({**doc, "tokens": count_tokens(content)})
+    return chunks
+
+
+# 採用したチャンクを、ドキュメントごと(最上位のチャンクが含まれるドキュメントの順)にまとめてテキストにする
+def __format_chunks(chunks: list[dict]) -> str:
+    docs_groups = defaultdict(list)
+    for chunk in chunks:
+        docs_groups[chunk["sourceDocumentId"]].append(chunk)
+
+    doc_contents = []
+    for i, doc_chunks in enumerate(docs_groups.values()):
+        parts = [DOC_HEADER_TEMPLATE.format(no=i + 1)]
+        last_chunk_no = -1
+        for chunk in sorted(doc_chunks, key=lambda x: x["chunkNo"]):
+            parts.append(CHUNK_SEPARATOR if chunk["chunkNo"] == last_chunk_no + 1 else GAP_SEPARATOR)
+            parts.append(chunk["content"])
+            last_chunk_no = chunk["chunkNo"]
+        doc_contents.append("".join(parts))
+
+    return DOC_SEPARATOR.join(doc_contents).strip()
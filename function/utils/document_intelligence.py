@@ -1,12 +1,21 @@
 import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+import unicodedata
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import TokenCredential, AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, DocumentAnalysisFeature, ContentFormat
 
 AZURE_DOC_INTELLIGENCE_NAME = os.getenv("AZURE_DOC_INTELLIGENCE_NAME")
 AZURE_DOC_INTELLIGENCE_KEY = os.getenv("AZURE_DOC_INTELLIGENCE_KEY")
 
+logger = logging.getLogger(__name__)
+
 
 class DocumentReader:
 
@@ -15,6 +24,8 @@ class DocumentReader:
         account_name: str = None,
         credential: TokenCredential = DefaultAzureCredential(),
         key: str = None,
+        cache_container=None,  # BlobContainer
+        cache_prefix: str = "ocr-cache/",
     ):
         account_name = account_name or AZURE_DOC_INTELLIGENCE_NAME
         key = key or AZURE_DOC_INTELLIGENCE_KEY
@@ -25,6 +36,10 @@ class DocumentReader:
             credential=credential,
         )
 
+        # 解析結果をファイル内容のハッシュ値と解析オプションをキーとして Blob にキャッシュする
+        self.cache_container = cache_container
+        self.cache_prefix = cache_prefix
+
     # ファイルを読み込んで Document Intelligence で解析してHTMLに変換して返す
     def read_document(
         self,
@@ -48,6 +63,16 @@ class DocumentReader:
         markdown: bool = False,
         pages: str = None,
     ) -> str:
+        # 同じ内容のファイルを同じオプションで解析済みの場合はキャッシュした解析結果を返す
+        cache_blob_name = None
+        if self.cache_container:
+            with open(file_path, "rb") as f:
+                content_hash = hashlib.file_digest(f, "sha256").hexdigest()
+            cache_blob_name = self.__get_cache_blob_name(content_hash, model, locale, high_resolution, markdown, pages)
+            result = self.__load_cached_result(cache_blob_name)
+            if result:
+                return result
+
         features = [DocumentAnalysisFeature.OCR_HIGH_RESOLUTION] if high_resolution else []
         output_content_format = ContentFormat.MARKDOWN if markdown else ContentFormat.TEXT
         with open(file_path, "rb") as f:
@@ -61,6 +86,7 @@ class DocumentReader:
                 pages=pages,
             )
         result = poller.result().as_dict()
+        self.__save_cached_result(cache_blob_name, result)
         return result
 
     # ファイルを読み込んで Document Intelligence で解析する
@@ -72,8 +98,9 @@ class DocumentReader:
         high_resolution: bool = True,
         markdown: bool = False,
         pages: str = None,
+        content_hash: str = None,
     ) -> str:
-        result = self.get_ocr_result_by_url(url, model, locale, high_resolution, markdown, pages)
+        result = self.get_ocr_result_by_url(url, model, locale, high_resolution, markdown, pages, content_hash)
         return self.get_content_from_ocr_result(result)
 
     # ファイルを読み込んで Document Intelligence で解析する
@@ -85,7 +112,16 @@ class DocumentReader:
         high_resolution: bool = True,
         markdown: bool = False,
         pages: str = None,
+        content_hash: str = None,
     ) -> str:
+        # URL の指すファイル内容のハッシュ値(content_hash)が指定され、同じオプションで解析済みの場合はキャッシュした解析結果を返す
+        cache_blob_name = None
+        if self.cache_container and content_hash:
+            cache_blob_name = self.__get_cache_blob_name(content_hash, model, locale, high_resolution, markdown, pages)
+            result = self.__load_cached_result(cache_blob_name)
+            if result:
+                return result
+
         features = [DocumentAnalysisFeature.OCR_HIGH_RESOLUTION] if high_resolution else []
         output_content_format = ContentFormat.MARKDOWN if markdown else ContentFormat.TEXT
         poller = self.client.begin_analyze_document(
@@ -97,8 +133,45 @@ class DocumentReader:
             pages=pages,
         )
         result = poller.result().as_dict()
+        self.__save_cached_result(cache_blob_name, result)
         return result
 
+    # ファイル内容のハッシュ値と解析オプションから、解析結果をキャッシュする Blob の名前を生成する
+    def __get_cache_blob_name(self, content_hash, model, locale, high_resolution, markdown, pages) -> str:
+        options = {
+            "content_hash": content_hash,
+            "model": model,
+            "locale": locale,
+            "high_resolution": high_resolution,
+            "markdown": markdown,
+            "pages": pages,
+        }
+        key = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+        return f"{self.cache_prefix}{key}.json.gz"
+
+    # キャッシュした解析結果を取得する(キャッシュが存在しない場合は None を返す)
+    # (キャッシュが壊れている場合や取得に失敗した場合も None を返し、Document Intelligence で解析し直す)
+    def __load_cached_result(self, cache_blob_name: str) -> dict:
+        try:
+            result = json.loads(gzip.decompress(self.cache_container.download_bytes(cache_blob_name)))
+            logger.info(f"ocr cache hit: {cache_blob_name}")
+            return result
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Failed to load ocr cache: {cache_blob_name}, {e}")
+            return None
+
+    # 解析結果を gzip 圧縮した JSON としてキャッシュする(キャッシュの保存に失敗しても解析結果は返す)
+    def __save_cached_result(self, cache_blob_name: str, result: dict):
+        if not cache_blob_name:
+            return
+        try:
+            data = gzip.compress(json.dumps(result, ensure_ascii=False).encode())
+            self.cache_container.upload_bytes(cache_blob_name, data)
+        except Exception as e:
+            logger.warning(f"Failed to save ocr cache: {cache_blob_name}, {e}")
+
     # Document Intelligence で処理した結果をHTMLに変換する
     def get_content_from_ocr_result(self, result):
 
@@ -131,6 +204,26 @@ class DocumentReader:
 
         return content
 
+    # get_content_from_ocr_result で変換したコンテンツから見出し(タイトル、セクション見出し)の位置を取得する
+    def get_headings_from_content(self, content: str) -> list[dict]:
+        headings = []
+        for m in re.finditer(r"<h([12])>(.*?)</h\1>", content, flags=re.DOTALL):
+            headings.append(
+                {
+                    "offset": m.start(),
+                    "level": int(m.group(1)),
+                    "content": m.group(2),
+                    "normalized_content": self.normalize_heading(m.group(2)),
+                }
+            )
+        return headings
+
+    # 見出しを照合するために、文字幅の違い(全角/半角)と空白を除いた文字列に正規化する
+    def normalize_heading(self, heading: str) -> str:
+        heading = unicodedata.normalize("NFKC", heading)
+        heading = re.sub(r"<[^>]+>", "", heading)
+        return re.sub(r"\s+", "", heading)
+
     # Document Intelligence で取得したテーブル情報をHTMLに変換する
     def __convert_table_to_html(self, table):
         cells = table["cells"]
@@ -0,0 +1,130 @@
+import os
+import struct
+import hashlib
+import threading
+from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+
+EMBEDDING_CACHE_MEMORY_ITEMS = int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", 2000))
+
+
+class EmbeddingCache:
+
+    def __init__(
+        self,
+        blob_container=None,  # BlobContainer
+        max_memory_items: int = None,
+        prefix: str = "embedding-cache/",
+        max_workers: int = 8,
+    ):
+        self.blob_container = blob_container
+        self.max_memory_items = max_memory_items or EMBEDDING_CACHE_MEMORY_ITEMS
+        self.prefix = prefix
+        self.max_workers = max_workers
+
+        # メモリ上のキャッシュ(LRU)。埋め込みは float32 のバイト列として保持する
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        # キャッシュのヒット率を計測するためのカウンタ
+        self.memory_hits = 0
+        self.blob_hits = 0
+        self.misses = 0
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        テキストの埋め込みをキャッシュから取得します。メモリ、Blob の順に参照します。
+
+        :param model_name: 埋め込みの生成に使用するモデル(デプロイ)名
+        :param texts: 埋め込み取得対象のテキストのリスト
+        :return: 埋め込みのリスト(キャッシュに存在しないテキストは None)
+        """
+        keys = [self.__get_key(model_name, text) for text in texts]
+        embeds = [None] * len(texts)
+
+        # メモリ上のキャッシュを参照する
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    embeds[i] = self.memory[key]
+                    self.memory_hits += 1
+
+        # メモリ上に存在しないものは Blob に保存されたキャッシュを並列に参照する
+        missing_indexes = [i for i, e in enumerate(embeds) if e is None]
+        if self.blob_container and missing_indexes:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(lambda i: self.__download(keys[i]), missing_indexes))
+            for i, data in zip(missing_indexes, results):
+                if data is not None:
+                    embeds[i] = data
+                    self.__put_memory(keys[i], data)
+            blob_hits = len([d for d in results if d is not None])
+        else:
+            blob_hits = 0
+
+        with self.lock:
+            self.blob_hits += blob_hits
+            self.misses += len(missing_indexes) - blob_hits
+
+        return [self.__decode(e) if e is not None else None for e in embeds]
+
+    def put_many(self, model_name: str, texts: List[str], embeds: List[List[float]]):
+        """
+        テキストの埋め込みをメモリと Blob のキャッシュに保存します。
+
+        :param model_name: 埋め込みの生成に使用したモデル(デプロイ)名
+        :param texts: テキストのリスト
+        :param embeds: 埋め込みのリスト(texts と同じ順序)
+        """
+        items = [(self.__get_key(model_name, text), self.__encode(embed)) for text, embed in zip(texts, embeds)]
+        for key, data in items:
+            self.__put_memory(key, data)
+        if self.blob_container and items:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda item: self.blob_container.upload_bytes(item[0], item[1]), items))
+
+    def get_stats(self) -> dict:
+        """
+        キャッシュのヒット数とヒット率を取得します。
+
+        :return: メモリ・Blob それぞれのヒット数、ミス数、ヒット率
+        """
+        with self.lock:
+            requests = self.memory_hits + self.blob_hits + self.misses
+            return {
+                "requests": requests,
+                "memory_hits": self.memory_hits,
+                "blob_hits": self.blob_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.blob_hits) / requests if requests else 0.0,
+            }
+
+    # モデル名とテキストの SHA-256 ハッシュ値からキャッシュのキー(Blob の名前)を生成する
+    def __get_key(self, model_name: str, text: str) -> str:
+        return f"{self.prefix}{model_name}/{hashlib.sha256(text.encode()).hexdigest()}.f32"
+
+    # Blob に保存されたキャッシュを取得する(存在しない場合は None を返す)
+    def __download(self, key: str) -> Optional[bytes]:
+        try:
+            return self.blob_container.download_bytes(key)
+        except ResourceNotFoundError:
+            return None
+
+    # メモリ上のキャッシュに追加し、上限を超えた場合は最も古く参照されたものから削除する
+    def __put_memory(self, key: str, data: bytes):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_items:
+                self.memory.popitem(last=False)
+
+    # 埋め込みを float32 (リトルエンディアン) のバイト列に変換する
+    def __encode(self, embed: List[float]) -> bytes:
+        return struct.pack(f"<{len(embed)}f", *embed)
+
+    # float32 (リトルエンディアン) のバイト列を埋め込みに変換する
+    def __decode(self, data: bytes) -> List[float]:
+        return list(struct.unpack(f"<{len(data) // 4}f", data))
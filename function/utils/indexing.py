@@ -0,0 +1,76 @@
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentIndexer:
+
+    def __init__(
+        self,
+        search_client,  # AISearchClient
+        embed_client,  # EmbeddingsClient
+        upload_batch_size: int = 100,
+    ):
+        self.search_client = search_client
+        self.embed_client = embed_client
+        self.upload_batch_size = upload_batch_size
+
+    def index_chunks(self, doc_id: str, src_group_id: str, chunks: list[str]) -> dict:
+        """
+        ドキュメントのチャンクを Azure AI Search のインデックスに格納します。
+        チャンクのキーはドキュメントID・チャンク番号・内容のハッシュ値から決まるため、インデックスに格納済みのチャンクと比較し、
+        追加・変更されたチャンクのみ埋め込みを取得して格納し、不要になったチャンクはまとめて削除します。
+        同じドキュメントを何度処理しても、インデックスの内容は最後に処理した結果と一致します。
+
+        :param doc_id: 情報源ドキュメントのID
+        :param src_group_id: 情報源グループのID
+        :param chunks: チャンクのリスト(インデックスがチャンク番号となる)
+        :return: 格納・変更なし・削除したチャンクの数
+        """
+        chunk_ids = [self.get_chunk_id(doc_id, i, chunk) for i, chunk in enumerate(chunks)]
+
+        # インデックスに格納済みのチャンクのキーを取得し、追加・変更されたチャンクを特定する
+        existing_ids = set(self.search_client.list_ids(f"sourceDocumentId eq '{doc_id}'"))
+        changed_indexes = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in existing_ids]
+
+        # 追加・変更されたチャンクの埋め込みを並列に取得し、取得できたものからインデックスに格納する
+        index_docs = []
+        changed_chunks = [chunks[i] for i in changed_indexes]
+        for j, embed in self.embed_client.iter_embeds_concurrently(changed_chunks):
+            i = changed_indexes[j]
+            index_docs.append(
+                {
+                    "id": chunk_ids[i],
+                    "sourceGroupId": src_group_id,
+                    "sourceDocumentId": doc_id,
+                    "chunkNo": i,
+                    "content": chunks[i],
+                    "contentVector": embed,
+                }
+            )
+            if len(index_docs) >= self.upload_batch_size:
+                self.search_client.merge_or_upload_documents(index_docs)
+                index_docs = []
+        self.search_client.merge_or_upload_documents(index_docs)
+
+        # 今回のチャンク分割の結果に含まれないチャンクを削除する
+        orphan_ids = list(existing_ids - set(chunk_ids))
+        self.search_client.delete_documents(orphan_ids)
+
+        stats = {"uploaded": len(changed_indexes), "unchanged": len(chunks) - len(changed_indexes), "deleted": len(orphan_ids)}
+        logger.info(f"indexed chunks: {doc_id} {stats}")
+        return stats
+
+    @staticmethod
+    def get_chunk_id(doc_id: str, chunk_no: int, chunk: str) -> str:
+        """
+        ドキュメントID・チャンク番号・チャンクの内容のハッシュ値から、チャンクのキーを生成します。
+
+        :param doc_id: 情報源ドキュメントのID
+        :param chunk_no: チャンク番号
+        :param chunk: チャンクの内容
+        :return: チャンクのキー(Azure AI Search のキーに使用できる文字のみで構成される)
+        """
+        content_hash = hashlib.sha256(chunk.encode()).hexdigest()[:16]
+        return f"{doc_id}-{chunk_no}-{content_hash}"
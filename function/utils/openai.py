@@ -1,14 +1,191 @@
 import os
 import json
+import time
 import threading
-from openai import AzureOpenAI
-from typing import List, Callable
+import tiktoken
+from openai import AzureOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from typing import List, Callable, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from utils.embedding_cache import EmbeddingCache
 
 AZURE_OPENAI_ACCOUNT_NAME = os.getenv("AZURE_OPENAI_ACCOUNT_NAME")
 AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
 AZURE_OPENAI_CHAT_MODEL = os.getenv("AZURE_OPENAI_CHAT_MODEL")
 AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL")
+AZURE_OPENAI_CHAT_TPM = os.getenv("AZURE_OPENAI_CHAT_TPM")
+AZURE_OPENAI_CHAT_RPM = os.getenv("AZURE_OPENAI_CHAT_RPM")
+AZURE_OPENAI_EMBED_TPM = os.getenv("AZURE_OPENAI_EMBED_TPM")
+AZURE_OPENAI_EMBED_RPM = os.getenv("AZURE_OPENAI_EMBED_RPM")
+AZURE_OPENAI_EMBED_CONCURRENCY = os.getenv("AZURE_OPENAI_EMBED_CONCURRENCY", 4)
+
+# 一時的なエラーとして再試行する例外(接続エラー・タイムアウト・5xx)
+# (SDK の自動再試行は無効化しているため、レート制限(429)と合わせて RateLimiter.run で再試行する)
+TRANSIENT_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError)
+
+
+class RateLimiter:
+
+    def __init__(self, tokens_per_minute: int = None, requests_per_minute: int = None):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.available_tokens = float(tokens_per_minute or 0)
+        self.available_requests = float(requests_per_minute or 0)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        """
+        1分あたりのトークン数およびリクエスト数の上限を超えないよう、送信可能になるまで待機してから予算を消費します
+
+        :param tokens: 送信するリクエストのトークン数
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.__refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    wait = max(
+                        self.__calc_wait(self.tokens_per_minute, self.available_tokens, tokens),
+                        self.__calc_wait(self.requests_per_minute, self.available_requests, 1),
+                    )
+                    if wait <= 0:
+                        if self.tokens_per_minute:
+                            self.available_tokens -= min(tokens, self.tokens_per_minute)
+                        if self.requests_per_minute:
+                            self.available_requests -= 1
+                        return
+            time.sleep(wait)
+
+    def run(self, func: Callable, tokens: int = 0, max_retries: int = 6):
+        """
+        送信可能になるまで待機してから関数を実行し、レート制限(429)を受けた場合はバックオフして再実行します
+        接続エラー・タイムアウト・5xx エラーの場合は、他のリクエストを止めずにこのリクエストのみ待機して再実行します
+
+        :param func: Azure OpenAI Service へリクエストを送信する関数
+        :param tokens: 送信するリクエストのトークン数
+        :param max_retries: レート制限・一時的なエラーを受けた場合の最大再試行回数
+        :return: 関数の戻り値
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire(tokens)
+            try:
+                return func()
+            except RateLimitError as e:
+                if attempt >= max_retries:
+                    raise
+                retry_after = e.response.headers.get("retry-after")
+                self.backoff(float(retry_after) if retry_after else min(2**attempt, 60))
+            except TRANSIENT_ERRORS:
+                if attempt >= max_retries:
+                    raise
+                time.sleep(min(2**attempt, 60))
+
+    def backoff(self, seconds: float):
+        """
+        レート制限(429)を受けた際に、指定した秒数の間すべてのリクエストの送信を停止し、残りの予算を破棄します
+
+        :param seconds: 送信を停止する秒数
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.available_tokens = min(self.available_tokens, 0)
+            self.available_requests = min(self.available_requests, 0)
+
+    def __refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.tokens_per_minute:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + self.tokens_per_minute * elapsed / 60)
+        if self.requests_per_minute:
+            self.available_requests = min(self.requests_per_minute, self.available_requests + self.requests_per_minute * elapsed / 60)
+
+    def __calc_wait(self, limit: int, available: float, required: int) -> float:
+        if not limit:
+            return 0
+        required = min(required, limit)
+        return max(0, (required - available) * 60 / limit)
+
+
+class ChatCompletionStream:
+
+    def __init__(
+        self,
+        create_stream: Callable,
+        rate_limiter: RateLimiter,
+        tiktoken_encoding: tiktoken.Encoding,
+        tokens: int = 0,
+        max_retries: int = 6,
+    ):
+        """
+        Chat Completion API のストリーミングレスポンスを、生成されたテキストの差分(delta)ごとに返すイテレータです。
+        最後まで読み込むと、生成されたテキスト全体と、最初のトークンまでの時間・1秒あたりの生成トークン数を参照できます。
+
+        :param create_stream: ストリーミングでの Chat Completion API の呼び出しを開始し、レスポンスを返す関数
+        :param rate_limiter: リクエストの送信を調整するレートリミッター
+        :param tiktoken_encoding: 生成されたトークン数を数えるためのエンコーディング
+        :param tokens: レート制限の計算に使用するリクエストのトークン数
+        :param max_retries: レート制限・一時的なエラーを受けた場合の最大再試行回数
+        """
+        self.create_stream = create_stream
+        self.rate_limiter = rate_limiter
+        self.tiktoken_encoding = tiktoken_encoding
+        self.tokens = tokens
+        self.max_retries = max_retries
+        self.content = ""
+        self.finish_reason = None
+        self.requested_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+    def __iter__(self) -> Iterator[str]:
+        stream = self.rate_limiter.run(self.__request, tokens=self.tokens, max_retries=self.max_retries)
+        for chunk in stream:
+            # コンテンツフィルターの結果のみを含むチャンクなど、生成されたテキストを含まないチャンクは読み飛ばす
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                self.finish_reason = choice.finish_reason
+            if not choice.delta or not choice.delta.content:
+                continue
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self.content += choice.delta.content
+            yield choice.delta.content
+        self.finished_at = time.monotonic()
+
+    # レート制限による待機時間を含めないよう、実際にリクエストを送信する直前の時刻を記録してから呼び出す
+    def __request(self):
+        self.requested_at = time.monotonic()
+        return self.create_stream()
+
+    @property
+    def time_to_first_token(self) -> float:
+        """
+        リクエストの送信から最初のトークンを受信するまでの時間(秒)
+        """
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.requested_at
+
+    @property
+    def completion_tokens(self) -> int:
+        """
+        生成されたトークン数
+        """
+        return len(self.tiktoken_encoding.encode_ordinary(self.content))
+
+    @property
+    def tokens_per_second(self) -> float:
+        """
+        最初のトークンの受信から生成の完了までの、1秒あたりの生成トークン数
+        """
+        if self.first_token_at is None or self.finished_at is None or self.finished_at <= self.first_token_at:
+            return None
+        return self.completion_tokens / (self.finished_at - self.first_token_at)
 
 
 class ChatCompletionClient:
@@ -20,10 +197,15 @@ class ChatCompletionClient:
         key: str = None,
         max_tokens: int = 4096,
         api_version: str = "2024-02-15-preview",
+        tokens_per_minute: int = None,
+        requests_per_minute: int = None,
+        max_retries: int = 6,
     ):
         account_name = account_name or AZURE_OPENAI_ACCOUNT_NAME
         model_name = model_name or AZURE_OPENAI_CHAT_MODEL
         key = key or AZURE_OPENAI_KEY
+        tokens_per_minute = tokens_per_minute or (int(AZURE_OPENAI_CHAT_TPM) if AZURE_OPENAI_CHAT_TPM else None)
+        requests_per_minute = requests_per_minute or (int(AZURE_OPENAI_CHAT_RPM) if AZURE_OPENAI_CHAT_RPM else None)
 
         if key:
             self.client = AzureOpenAI(
@@ -42,6 +224,9 @@ class ChatCompletionClient:
 
         self.model_name = model_name
         self.max_tokens = max_tokens
+        self.tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
+        self.rate_limiter = RateLimiter(tokens_per_minute, requests_per_minute)
+        self.max_retries = max_retries
 
     def get_completion(
         self,
@@ -59,16 +244,53 @@ class ChatCompletionClient:
         :return: 生成された Completion
         """
         response_format = {"type": "json_object"} if json_format else None
-        resp = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-            max_tokens=max_tokens if max_tokens else self.max_tokens,
-            temperature=temperature,
-            response_format=response_format,
+        max_tokens = max_tokens if max_tokens else self.max_tokens
+        resp = self.rate_limiter.run(
+            lambda: self.client.with_options(max_retries=0).chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                response_format=response_format,
+            ),
+            tokens=self.__estimate_tokens(messages, max_tokens),
+            max_retries=self.max_retries,
         )
         completion = resp.choices[0].message.content
         return completion
 
+    def get_completion_stream(
+        self,
+        messages: List[dict],
+        temperature: int = 0,
+        json_format: bool = False,
+        max_tokens: int = None,
+    ) -> ChatCompletionStream:
+        """
+        Azure OpenAI Service Chat Completion API から Completion をストリーミングで取得します
+
+        :param messages: チャットメッセージのリスト
+        :param json_format: JSON形式でのレスポンスを取得するかどうかのフラグ
+        :param temperature: Completion の生成に使用される温度パラメータ
+        :return: 生成された Completion の差分(delta)を順に返すイテレータ
+        """
+        response_format = {"type": "json_object"} if json_format else None
+        max_tokens = max_tokens if max_tokens else self.max_tokens
+        return ChatCompletionStream(
+            lambda: self.client.with_options(max_retries=0).chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                response_format=response_format,
+                stream=True,
+            ),
+            self.rate_limiter,
+            self.tiktoken_encoding,
+            tokens=self.__estimate_tokens(messages, max_tokens),
+            max_retries=self.max_retries,
+        )
+
     def get_completion_with_tools(
         self,
         messages: List[dict],
@@ -86,13 +308,17 @@ class ChatCompletionClient:
         :return: 生成された Completion
         """
         while True:
-            resp = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=temperature,
-                tools=tools,
-                tool_choice="auto",
+            resp = self.rate_limiter.run(
+                lambda: self.client.with_options(max_retries=0).chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    temperature=temperature,
+                    tools=tools,
+                    tool_choice="auto",
+                ),
+                tokens=self.__estimate_tokens(messages, self.max_tokens),
+                max_retries=self.max_retries,
             )
             choice = resp.choices[0]
             if choice.message.tool_calls:
@@ -123,6 +349,20 @@ class ChatCompletionClient:
         """
         return [{"role": "system", "content": system_message}, {"role": "user", "content": user_message}]
 
+    def __estimate_tokens(self, messages: List[dict], max_tokens: int) -> int:
+        """
+        レート制限の計算に使用する、リクエストで消費されるトークン数を見積もります
+        (トークン数の上限が設定されていない場合はトークン化を行わずに 0 を返します)
+
+        :param messages: チャットメッセージのリスト
+        :param max_tokens: 生成する最大トークン数
+        :return: 見積もったトークン数
+        """
+        if not self.rate_limiter.tokens_per_minute:
+            return 0
+        contents = [m["content"] for m in messages if isinstance(m, dict) and isinstance(m.get("content"), str)]
+        return sum(len(self.tiktoken_encoding.encode_ordinary(c)) for c in contents) + max_tokens
+
 
 class EmbeddingsClient:
 
@@ -132,10 +372,20 @@ class EmbeddingsClient:
         model_name: str = None,
         key: str = None,
         api_version: str = "2024-02-15-preview",
+        max_batch_size: int = 2048,
+        max_batch_tokens: int = 300000,
+        tokens_per_minute: int = None,
+        requests_per_minute: int = None,
+        max_workers: int = None,
+        max_retries: int = 6,
+        cache: EmbeddingCache = None,
     ):
         account_name = acount_name or AZURE_OPENAI_ACCOUNT_NAME
         model_name = model_name or AZURE_OPENAI_EMBED_MODEL
         key = key or AZURE_OPENAI_KEY
+        tokens_per_minute = tokens_per_minute or (int(AZURE_OPENAI_EMBED_TPM) if AZURE_OPENAI_EMBED_TPM else None)
+        requests_per_minute = requests_per_minute or (int(AZURE_OPENAI_EMBED_RPM) if AZURE_OPENAI_EMBED_RPM else None)
+        max_workers = max_workers or int(AZURE_OPENAI_EMBED_CONCURRENCY)
 
         if key:
             self.client = AzureOpenAI(
@@ -153,6 +403,13 @@ class EmbeddingsClient:
             )
 
         self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
+        self.rate_limiter = RateLimiter(tokens_per_minute, requests_per_minute)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.cache = cache
 
     def get_embeds(self, text: str) -> List[float]:
         """
@@ -164,3 +421,92 @@ class EmbeddingsClient:
         resp = self.client.embeddings.create(model=self.model_name, input=text)
         embed = resp.data[0].embedding
         return embed
+
+    def get_embeds_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数テキストの埋め込みを、1リクエストあたりの入力数およびトークン数の上限に収まる単位でまとめて取得します。
+
+        :param texts: 埋め込み取得対象のテキストのリスト
+        :return: 埋め込みのリスト(texts と同じ順序)
+        """
+        embeds, missing_indexes = self.__get_cached_embeds(texts)
+        missing_texts = [texts[i] for i in missing_indexes]
+        for start, batch, batch_tokens in self.__split_into_batches(missing_texts):
+            for i, embed in enumerate(self.__create_embeds(batch, batch_tokens)):
+                embeds[missing_indexes[start + i]] = embed
+        return embeds
+
+    def iter_embeds_concurrently(self, texts: List[str]) -> Iterator[Tuple[int, List[float]]]:
+        """
+        複数テキストの埋め込みを、バッチ単位で並列に取得し、取得できたものから順に返します。
+        TPM/RPM の上限に合わせて送信を調整し、レート制限(429)を受けた場合はバックオフして再試行します。
+
+        :param texts: 埋め込み取得対象のテキストのリスト
+        :return: (texts におけるインデックス, 埋め込み) のイテレータ(取得が完了した順)
+        """
+        # キャッシュに存在する埋め込みは API を呼び出さずに先に返す
+        embeds, missing_indexes = self.__get_cached_embeds(texts)
+        for i, embed in enumerate(embeds):
+            if embed is not None:
+                yield i, embed
+
+        missing_texts = [texts[i] for i in missing_indexes]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.__create_embeds, batch, batch_tokens): start
+                for start, batch, batch_tokens in self.__split_into_batches(missing_texts)
+            }
+            for future in as_completed(futures):
+                start = futures[future]
+                for i, embed in enumerate(future.result()):
+                    yield missing_indexes[start + i], embed
+
+    def __get_cached_embeds(self, texts: List[str]) -> Tuple[List[List[float]], List[int]]:
+        """
+        キャッシュから埋め込みを取得します。
+
+        :param texts: 埋め込み取得対象のテキストのリスト
+        :return: (埋め込みのリスト(キャッシュに存在しないものは None), キャッシュに存在しなかったテキストのインデックスのリスト)
+        """
+        if self.cache is None:
+            return [None] * len(texts), list(range(len(texts)))
+        embeds = self.cache.get_many(self.model_name, texts)
+        return embeds, [i for i, embed in enumerate(embeds) if embed is None]
+
+    def __create_embeds(self, batch: List[str], batch_tokens: int) -> List[List[float]]:
+        """
+        レート制限を考慮して、1バッチ分のテキストの埋め込みを取得します。
+
+        :param batch: 埋め込み取得対象のテキストのリスト
+        :param batch_tokens: バッチ全体のトークン数
+        :return: 埋め込みのリスト(batch と同じ順序)
+        """
+        resp = self.rate_limiter.run(
+            lambda: self.client.with_options(max_retries=0).embeddings.create(model=self.model_name, input=batch),
+            tokens=batch_tokens,
+            max_retries=self.max_retries,
+        )
+        embeds = [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+        if self.cache is not None:
+            self.cache.put_many(self.model_name, batch, embeds)
+        return embeds
+
+    def __split_into_batches(self, texts: List[str]) -> List[Tuple[int, List[str], int]]:
+        """
+        テキストのリストを、1リクエストあたりの入力数およびトークン数の上限に収まるバッチに分割します。
+
+        :param texts: 分割対象のテキストのリスト
+        :return: (バッチ先頭の texts におけるインデックス, バッチ, バッチのトークン数) のリスト
+        """
+        batches = []
+        start, batch, batch_tokens = 0, [], 0
+        for i, text in enumerate(texts):
+            tokens = len(self.tiktoken_encoding.encode_ordinary(text))
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append((start, batch, batch_tokens))
+                start, batch, batch_tokens = i, [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((start, batch, batch_tokens))
+        return batches
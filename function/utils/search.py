@@ -1,13 +1,24 @@
 import os
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import TokenCredential, AzureKeyCredential
+from azure.core.pipeline.transport import HttpTransport
 from azure.search.documents import SearchClient
+from azure.search.documents.models import VectorizedQuery
 from concurrent.futures.thread import ThreadPoolExecutor
 
 AI_SEARCH_ACCOUNT_NAME = os.getenv("AI_SEARCH_ACCOUNT_NAME")
 AI_SEARCH_INDEX_NAME = os.getenv("AI_SEARCH_INDEX_NAME")
 AI_SEARCH_API_VERSION = os.getenv("AI_SEARCH_API_VERSION", "2023-10-01-Preview")
 AI_SEARCH_API_KEY = os.getenv("AI_SEARCH_API_KEY")
+AI_SEARCH_SEMANTIC_CONFIGURATION_NAME = os.getenv("AI_SEARCH_SEMANTIC_CONFIGURATION_NAME", "semanticConfig")
+
+# フィルタに一致するドキュメントのキーを取得する際の1ページあたりの件数と、スキップできる件数の上限
+# (Azure AI Search は1リクエストあたり最大1000件を返し、skip に指定できるのは最大100000件まで)
+LIST_IDS_PAGE_SIZE = 1000
+LIST_IDS_MAX_SKIP = 100000
+
+# 検索結果として取得するフィールド(埋め込みベクトルは取得しない)
+SEARCH_RESULT_FIELDS = ["id", "sourceGroupId", "sourceDocumentId", "chunkNo", "content"]
 
 
 class AISearchClient:
@@ -18,6 +29,7 @@ class AISearchClient:
         index_name: str = None,
         credential: TokenCredential = DefaultAzureCredential(),
         key: str = None,
+        transport: HttpTransport = None,
     ):
         account_name = account_name or AI_SEARCH_ACCOUNT_NAME
         index_name = index_name or AI_SEARCH_INDEX_NAME
@@ -29,6 +41,7 @@ class AISearchClient:
             credential=credential,
             index_name=index_name,
             api_version=AI_SEARCH_API_VERSION,
+            transport=transport,
         )
 
     # インデックスを検索する
@@ -41,6 +54,39 @@ class AISearchClient:
         docs = self.client.search(search_text=query, filter=filter, top=top)
         return [d for d in docs]
 
+    # キーワード(BM25)検索とベクトル検索を組み合わせたハイブリッド検索でインデックスを検索する
+    # (両方の検索結果は Azure AI Search 上で Reciprocal Rank Fusion により統合され、1回のリクエストで取得する)
+    # semantic を指定した場合はセマンティックランカーで再ランク付けし、min_reranker_score 未満の結果を除外する
+    def hybrid_search(
+        self,
+        query: str,
+        vector: list[float],
+        filter: str = None,
+        top: int = 10,
+        k_nearest_neighbors: int = 50,
+        semantic: bool = False,
+        min_reranker_score: float = None,
+    ) -> list[dict]:
+        vector_query = VectorizedQuery(vector=vector, k_nearest_neighbors=max(k_nearest_neighbors, top), fields="contentVector")
+        semantic_options = {}
+        if semantic:
+            semantic_options = {
+                "query_type": "semantic",
+                "semantic_configuration_name": AI_SEARCH_SEMANTIC_CONFIGURATION_NAME,
+            }
+        docs = self.client.search(
+            search_text=query,
+            vector_queries=[vector_query],
+            filter=filter,
+            top=top,
+            select=SEARCH_RESULT_FIELDS,
+            **semantic_options,
+        )
+        docs = [d for d in docs]
+        if semantic and min_reranker_score is not None:
+            docs = [d for d in docs if (d.get("@search.reranker_score") or 0) >= min_reranker_score]
+        return docs
+
     # インデックスにドキュメントを追加する
     def register_documents(self, docs: list[dict], chunk_size: int = 100):
         chunks = [docs[i : i + chunk_size] for i in range(0, len(docs), chunk_size)]
@@ -49,7 +95,39 @@ class AISearchClient:
             threads = [executor.submit(upload_documents, c) for c in chunks]
             [t.result() for t in threads]
 
+    # インデックスにドキュメントを追加する(同じキーのドキュメントが存在する場合は更新する)
+    def merge_or_upload_documents(self, docs: list[dict], chunk_size: int = 100):
+        chunks = [docs[i : i + chunk_size] for i in range(0, len(docs), chunk_size)]
+        merge_or_upload_documents = lambda d: self.client.merge_or_upload_documents(documents=d)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            threads = [executor.submit(merge_or_upload_documents, c) for c in chunks]
+            [t.result() for t in threads]
+
+    # フィルタに一致するすべてのドキュメントのキーを取得する(キー以外のフィールドは取得しない)
+    # 1000件ずつページを明示して取得し、skip の上限を超えて一覧できない場合は結果を切り捨てずに例外を送出する
+    def list_ids(self, filter: str) -> list[str]:
+        ids = []
+        while True:
+            if len(ids) > LIST_IDS_MAX_SKIP:
+                raise ValueError(f"Too many documents to list: {filter}")
+            docs = self.client.search(search_text="*", filter=filter, select=["id"], top=LIST_IDS_PAGE_SIZE, skip=len(ids))
+            page = [d["id"] for d in docs]
+            ids += page
+            if len(page) < LIST_IDS_PAGE_SIZE:
+                return ids
+
     # インデックスのドキュメントを削除する
-    def delete_documents(self, ids: list[str]):
+    def delete_documents(self, ids: list[str], chunk_size: int = 1000, max_workers: int = 4):
         docs = [{"id": id} for id in ids]
-        self.client.delete_documents(documents=docs)
+        chunks = [docs[i : i + chunk_size] for i in range(0, len(docs), chunk_size)]
+        delete_documents = lambda d: self.client.delete_documents(documents=d)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            threads = [executor.submit(delete_documents, c) for c in chunks]
+            [t.result() for t in threads]
+
+    # フィルタ(sourceDocumentId, sourceGroupId など)に一致するすべてのドキュメントを削除し、削除した件数を返す
+    # キーのみをページ単位で一覧した後、バッチに分けて並列に削除する
+    def purge_documents(self, filter: str, chunk_size: int = 1000, max_workers: int = 4) -> int:
+        ids = self.list_ids(filter)
+        self.delete_documents(ids, chunk_size, max_workers)
+        return len(ids)
@@ -3,32 +3,79 @@ import json
 import uuid
 import base64
 import logging
+import time
 import datetime
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from flask_cors import CORS
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from utils.blob import BlobContainer
 from utils.cosmos import CosmosContainer
 from utils.search import AISearchClient
+from utils.progress import ProgressChannel
+from utils.http import create_pooled_session, create_transport, WEB_THREADS
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 
 # サポートするドキュメントファイルの拡張子を定義する
 SUPPORT_FILE_EXTENSIONS = ["pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx"]
 
+# ブラウザから Azure Blob Storage へ直接アップロードするための SAS 付き URL の有効期限(秒)
+# (登録後も有効期限まではファイルを上書きできるため、アップロードに必要な時間に留める)
+DIRECT_UPLOAD_SAS_EXPIRY = int(os.getenv("DIRECT_UPLOAD_SAS_EXPIRY", 900))
+
+# アップロード中のドキュメントを表す Cosmos DB のアイテムの種類と、登録されなかった場合に削除されるまでの時間(秒)
+PENDING_UPLOAD_TYPE = "pending_upload"
+PENDING_UPLOAD_TTL = DIRECT_UPLOAD_SAS_EXPIRY + 3600
+
+# 一覧を取得するAPIで1ページあたりに返す最大件数
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", 1000))
+
+# 生成の進捗を Server-Sent Events で配信する際の、進捗イベントの確認間隔・ハートビート間隔・最大接続時間(秒)
+# (最大接続時間を過ぎるとストリームを終了し、ブラウザの EventSource が Last-Event-ID を付けて再接続する)
+# (接続中はワーカーのスレッドを1つ占有し、確認間隔ごとに Azure Blob Storage へリクエストするため、接続時間を短く区切る)
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", 1))
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))
+SSE_MAX_DURATION = float(os.getenv("SSE_MAX_DURATION", 120))
+SSE_RECONNECT_INTERVAL = int(os.getenv("SSE_RECONNECT_INTERVAL", 1000))
+
+# ワーカーあたりの Server-Sent Events の同時接続数の上限(既定はワーカーのスレッド数の1/4)
+# (上限を超えた場合は 503 を返し、ブラウザは定期的に生成状況を取得する方式に切り替える)
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", max(1, WEB_THREADS // 4)))
+sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
 # Azure Application Insights でのログ出力を有効化する
 logger = logging.getLogger(__name__)
 APP_INSIGHTS_CONNECTION_STRING = os.getenv("APP_INSIGHTS_CONNECTION_STRING")
 logger.addHandler(AzureLogHandler(connection_string=APP_INSIGHTS_CONNECTION_STRING))
 
+# 各 Azure サービスのクライアントで共有する HTTP コネクションプールを生成する
+http_session = create_pooled_session()
+
 # Azure Blob Storage にアクセスするためのインスタンスを生成する
-blob_container = BlobContainer()
+blob_container = BlobContainer(transport=create_transport(http_session))
 
 # Azure Cosmos DB にアクセスするためのインスタンスを生成する
-docs_cosmos_container = CosmosContainer(container_name=os.getenv("AZURE_COSMOS_DOCS_CONTAINER_NAME"))
-groups_cosmos_container = CosmosContainer(container_name=os.getenv("AZURE_COSMOS_GROUPS_CONTAINER_NAME"))
+# (サイズの大きいフィールドは Azure Blob Storage に退避されているため、アイテムの削除時に合わせて削除する)
+# (アイテムは所有ユーザのIDをパーティションキーとして格納し、ユーザ単位のポイント読み取りとクエリで取得する)
+docs_cosmos_container = CosmosContainer(
+    container_name=os.getenv("AZURE_COSMOS_DOCS_CONTAINER_NAME"),
+    transport=create_transport(http_session),
+    blob_container=blob_container,
+    offload_fields=["content", "analysis_result", "chapter_contents"],
+    partition_key_field="owner_user_id",
+)
+groups_cosmos_container = CosmosContainer(
+    container_name=os.getenv("AZURE_COSMOS_GROUPS_CONTAINER_NAME"),
+    transport=create_transport(http_session),
+    partition_key_field="owner_user_id",
+)
 
 # Azure AI Search にアクセスするためのインスタンスを生成する
-search_client = AISearchClient()
+search_client = AISearchClient(transport=create_transport(http_session))
+
+# Azure Functions が発行するドキュメント生成の進捗イベントを取得するためのインスタンスを生成する
+progress_channel = ProgressChannel(blob_container)
 
 app = Flask(__name__)
 CORS(app)
@@ -55,10 +102,11 @@ def list_ref_docs_api():
         WHERE 
             c.owner_user_id = @user_id 
             AND c.type = "reference"
+        ORDER BY
+            c.created_at DESC
     """
     parameters = [{"name": "@user_id", "value": user_id}]
-    docs = docs_cosmos_container.query_items(query, parameters)
-    return docs, 200
+    return query_list(docs_cosmos_container, query, parameters, user_id)
 
 
 # リファレンスドキュメントをアップロードするAPI
@@ -80,14 +128,12 @@ def upload_ref_doc_api():
     if file_extention not in SUPPORT_FILE_EXTENSIONS:
         return "", 400
 
-    # ファイルを読み込む
-    bytes = file.read()
-
     # リファレンスドキュメントのIDを生成する
     doc_id = str(uuid.uuid4())
 
-    # ファイルをAzure Blob Storage にアップロードする
-    blob_container.upload_bytes(doc_id, bytes)
+    # ファイルをメモリに読み込まず、ブロック単位で Azure Blob Storage にアップロードする
+    # (アップロードしながら計算したハッシュ値は、Azure Functions で解析結果のキャッシュを参照する際に使用する)
+    content_sha256, content_etag = blob_container.upload_stream(doc_id, file.stream)
 
     # ログインユーザ情報を取得する
     user_id, _ = get_user_info()
@@ -100,6 +146,8 @@ def upload_ref_doc_api():
         "name": file_name,
         "file_extention": file_extention,
         "status": "uploaded",
+        "content_sha256": content_sha256,
+        "content_etag": content_etag,
         "created_at": datetime.datetime.now().isoformat(),
     }
     docs_cosmos_container.upsert_item(doc)
@@ -107,6 +155,18 @@ def upload_ref_doc_api():
     return doc_id, 201
 
 
+# リファレンスドキュメントを Azure Blob Storage へ直接アップロードするための URL を発行するAPI
+@app.route("/api/reference/upload/initiate", methods=["POST"])
+def initiate_ref_doc_upload_api():
+    return initiate_direct_upload({"type": "reference"})
+
+
+# Azure Blob Storage へ直接アップロードしたリファレンスドキュメントを登録するAPI
+@app.route("/api/reference/upload/<doc_id>/finalize", methods=["POST"])
+def finalize_ref_doc_upload_api(doc_id):
+    return finalize_direct_upload(doc_id, {"type": "reference"})
+
+
 # 指定したリファレンスドキュメントを削除するAPI
 @app.route("/api/reference/<doc_id>", methods=["DELETE"])
 def delete_ref_doc_api(doc_id):
@@ -114,17 +174,10 @@ def delete_ref_doc_api(doc_id):
     # ログインユーザ情報を取得する
     user_id, _ = get_user_info()
 
-    # 指定したドキュメントが存在するかを確認する
-    doc = docs_cosmos_container.get_item(doc_id)
-    if not doc:
-        return "", 404
-
-    # ログインユーザが削除操作ができるかを確認する
-    if doc["owner_user_id"] != user_id:
-        return "", 403
-
     # ドキュメントを Cosmos DB から削除する
-    docs_cosmos_container.delete_item(doc_id)
+    # (ログインユーザのパーティションのみを対象とするため、他のユーザのドキュメントは存在しないものとして扱う)
+    if not docs_cosmos_container.delete_item(doc_id, partition_key=user_id):
+        return "", 404
 
     # ドキュメントを Azure Blob Storage から削除する
     blob_container.delete_blob(doc_id)
@@ -144,10 +197,11 @@ def list_src_groups_api():
         FROM c 
         WHERE 
             c.owner_user_id = @user_id
+        ORDER BY
+            c.created_at DESC
     """
     parameters = [{"name": "@user_id", "value": user_id}]
-    groups = groups_cosmos_container.query_items(query, parameters)
-    return groups, 200
+    return query_list(groups_cosmos_container, query, parameters, user_id)
 
 
 # 情報源グループを作成するAPI
@@ -183,25 +237,22 @@ def delete_src_group_api(group_id):
     # ログインユーザ情報を取得する
     user_id, _ = get_user_info()
 
-    # 指定したグループが存在するかを確認する
-    group = groups_cosmos_container.get_item(group_id)
-    if not group:
+    # Azure Cosmos DB から情報源グループを削除する
+    # (ログインユーザのパーティションのみを対象とするため、他のユーザのグループは存在しないものとして扱う)
+    if not groups_cosmos_container.delete_item(group_id, partition_key=user_id):
         return "", 404
 
-    # ログインユーザが削除操作ができるかを確認する
-    if group["owner_user_id"] != user_id:
-        return "", 403
-
-    # Azure Cosmos DB から情報源グループを削除する
-    groups_cosmos_container.delete_item(group_id)
+    # 情報源グループに関連するチャンクを Azure AI Search からまとめて削除する
+    search_client.purge_documents(f"sourceGroupId eq '{group_id}'")
 
-    # 情報源グループに関連する情報源ドキュメントを削除する
+    # 情報源グループに関連する情報源ドキュメントを並列に削除する
     docs = docs_cosmos_container.query_items(
         "SELECT c.id FROM c WHERE c.group_id = @group_id",
         [{"name": "@group_id", "value": group_id}],
+        partition_key=user_id,
     )
-    for doc in docs:
-        delete_source_doc(doc["id"])
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda doc: delete_source_doc(doc["id"], user_id, delete_index=False), docs))
 
     return "", 204
 
@@ -222,13 +273,14 @@ def list_src_docs_api(group_id):
             c.owner_user_id = @user_id 
             AND c.group_id = @group_id 
             AND c.type = "source"
+        ORDER BY
+            c.created_at DESC
     """
     parameters = [
         {"name": "@user_id", "value": user_id},
         {"name": "@group_id", "value": group_id},
     ]
-    docs = docs_cosmos_container.query_items(query, parameters)
-    return docs, 200
+    return query_list(docs_cosmos_container, query, parameters, user_id)
 
 
 # 情報源ドキュメントをアップロードするAPI
@@ -253,14 +305,12 @@ def upload_src_doc_api(group_id):
     if file_extention not in SUPPORT_FILE_EXTENSIONS:
         return "", 400
 
-    # ファイルを読み込む
-    bytes = file.read()
-
     # ドキュメントのIDを生成する
     doc_id = str(uuid.uuid4())
 
-    # ファイルをAzure Blob Storage にアップロードする
-    blob_container.upload_bytes(doc_id, bytes)
+    # ファイルをメモリに読み込まず、ブロック単位で Azure Blob Storage にアップロードする
+    # (アップロードしながら計算したハッシュ値は、Azure Functions で解析結果のキャッシュを参照する際に使用する)
+    content_sha256, content_etag = blob_container.upload_stream(doc_id, file.stream)
 
     # ドキュメントのデータを Cosmos DB に保存する
     doc = {
@@ -271,6 +321,8 @@ def upload_src_doc_api(group_id):
         "file_extention": file_extention,
         "status": "uploaded",
         "group_id": group_id,
+        "content_sha256": content_sha256,
+        "content_etag": content_etag,
         "created_at": datetime.datetime.now().isoformat(),
     }
     docs_cosmos_container.upsert_item(doc)
@@ -278,6 +330,18 @@ def upload_src_doc_api(group_id):
     return doc_id, 201
 
 
+# 情報源ドキュメントを Azure Blob Storage へ直接アップロードするための URL を発行するAPI
+@app.route("/api/sourceGroup/<group_id>/source/upload/initiate", methods=["POST"])
+def initiate_src_doc_upload_api(group_id):
+    return initiate_direct_upload({"type": "source", "group_id": group_id})
+
+
+# Azure Blob Storage へ直接アップロードした情報源ドキュメントを登録するAPI
+@app.route("/api/sourceGroup/<group_id>/source/upload/<doc_id>/finalize", methods=["POST"])
+def finalize_src_doc_upload_api(group_id, doc_id):
+    return finalize_direct_upload(doc_id, {"type": "source", "group_id": group_id})
+
+
 # 情報源ドキュメントを削除するAPI
 @app.route("/api/sourceGroup/<group_id>/source/<doc_id>", methods=["DELETE"])
 def delete_src_doc_api(group_id, doc_id):
@@ -285,34 +349,107 @@ def delete_src_doc_api(group_id, doc_id):
     # ログインユーザ情報を取得する
     user_id, _ = get_user_info()
 
-    # 指定したドキュメントが存在するかを確認する
-    doc = docs_cosmos_container.get_item(doc_id)
-    if not doc:
-        return "", 404
-
-    # ログインユーザが削除操作ができるかを確認する
-    if doc["owner_user_id"] != user_id:
-        return "", 403
-
     # Cosmos DB, AI Search, Blob Storage から情報源ドキュメントを削除する
-    delete_source_doc(doc_id)
+    # (ログインユーザのパーティションのみを対象とするため、他のユーザのドキュメントは存在しないものとして扱う)
+    if not delete_source_doc(doc_id, user_id):
+        return "", 404
 
     return "", 204
 
 
 # Cosmos DB, AI Search, Blob Storage から情報源ドキュメントを削除する
-def delete_source_doc(doc_id: str):
+# (delete_index が False の場合は Azure AI Search のチャンクを削除しない。グループ単位でまとめて削除する場合に指定する)
+# (ドキュメントが存在しない場合は何も削除せずに False を返す)
+def delete_source_doc(doc_id: str, user_id: str, delete_index: bool = True) -> bool:
 
     # ドキュメントを Cosmos DB から削除する
-    docs_cosmos_container.delete_item(doc_id)
+    if not docs_cosmos_container.delete_item(doc_id, partition_key=user_id):
+        return False
 
-    # ドキュメントを Azure AI Search から削除する
-    docs = search_client.search("*", f"sourceDocumentId eq '{doc_id}'", top=1000)
-    if len(docs) > 0:
-        search_client.delete_documents([d["id"] for d in docs])
+    # ドキュメントのすべてのチャンクを Azure AI Search から削除する
+    if delete_index:
+        search_client.purge_documents(f"sourceDocumentId eq '{doc_id}'")
 
     # ドキュメントを Azure Blob Storage から削除する
     blob_container.delete_blob(doc_id)
+    return True
+
+
+# ドキュメントファイルをブラウザから Azure Blob Storage へ直接アップロードするための書き込み用 SAS 付き URL を発行する
+# (ファイルが Web アプリを経由しないため、アップロードのスループットが Web アプリの CPU や帯域に依存しない)
+def initiate_direct_upload(attributes: dict):
+
+    # リクエストからファイル名を取得し、拡張子を確認する
+    file_name = (request.json or {}).get("fileName")
+    if not file_name or file_name.split(".")[-1] not in SUPPORT_FILE_EXTENSIONS:
+        return "", 400
+
+    # ログインユーザ情報を取得する
+    user_id, _ = get_user_info()
+
+    # ドキュメントのIDを生成し、アップロード中のドキュメントとして Cosmos DB に記録する
+    # (登録時に、URL を発行したユーザと登録するユーザが同じであることを確認するため)
+    # (登録されなかった場合は、有効期限(ttl)が切れると自動的に削除される)
+    doc_id = str(uuid.uuid4())
+    pending_upload = {
+        "id": doc_id,
+        "owner_user_id": user_id,
+        "type": PENDING_UPLOAD_TYPE,
+        "status": "pending",
+        "attributes": attributes,
+        "ttl": PENDING_UPLOAD_TTL,
+        "created_at": datetime.datetime.now().isoformat(),
+    }
+    docs_cosmos_container.upsert_item(pending_upload)
+
+    # そのIDを名前とするBlobへの書き込み用 SAS 付き URL を発行する
+    upload_url = blob_container.get_url_with_sas(doc_id, read=False, write=True, expiry=DIRECT_UPLOAD_SAS_EXPIRY)
+
+    return {"docId": doc_id, "uploadUrl": upload_url}, 201
+
+
+# Azure Blob Storage へ直接アップロードされたドキュメントファイルのデータを Cosmos DB に保存する
+def finalize_direct_upload(doc_id: str, attributes: dict):
+
+    # リクエストからファイル名を取得し、拡張子を確認する
+    file_name = (request.json or {}).get("fileName")
+    if not file_name:
+        return "", 400
+    file_extention = file_name.split(".")[-1]
+    if file_extention not in SUPPORT_FILE_EXTENSIONS:
+        return "", 400
+
+    # ログインユーザ情報を取得する
+    user_id, _ = get_user_info()
+
+    # ログインユーザが URL を発行したアップロード中のドキュメントであり、まだ登録されていないことを確認する
+    pending_upload = docs_cosmos_container.get_item(doc_id, partition_key=user_id)
+    if not pending_upload or pending_upload["owner_user_id"] != user_id:
+        return "", 404
+    if pending_upload["type"] != PENDING_UPLOAD_TYPE:
+        return "", 409
+    if pending_upload["attributes"] != attributes:
+        return "", 400
+
+    # ファイルがアップロード済みであることを確認し、Azure Functions で解析結果のキャッシュを参照するためのハッシュ値を計算する
+    if not blob_container.exists(doc_id):
+        return "", 404
+    content_sha256, content_etag = blob_container.get_sha256(doc_id)
+
+    # ドキュメントのデータを Cosmos DB に保存する(アップロード中のドキュメントを置き換え、有効期限を解除する)
+    doc = {
+        "id": doc_id,
+        "owner_user_id": user_id,
+        "name": file_name,
+        "file_extention": file_extention,
+        "status": "uploaded",
+        "content_sha256": content_sha256,
+        "content_etag": content_etag,
+        "created_at": datetime.datetime.now().isoformat(),
+    } | attributes
+    docs_cosmos_container.upsert_item(doc)
+
+    return doc_id, 201
 
 
 # 生成したドキュメント一覧を取得するAPI
@@ -330,10 +467,11 @@ def list_generated_docs_api():
         WHERE 
             c.owner_user_id = @user_id 
             AND c.type = "generated"
+        ORDER BY
+            c.created_at DESC
     """
     parameters = [{"name": "@user_id", "value": user_id}]
-    docs = docs_cosmos_container.query_items(query, parameters)
-    return docs, 200
+    return query_list(docs_cosmos_container, query, parameters, user_id)
 
 
 # 指定した生成ドキュメントを取得するAPI
@@ -344,7 +482,7 @@ def get_generated_doc_api(doc_id):
     user_id, _ = get_user_info()
 
     # ドキュメントを Cosmos DB から取得する
-    doc = docs_cosmos_container.get_item(doc_id)
+    doc = docs_cosmos_container.get_item(doc_id, partition_key=user_id)
 
     # ドキュメントが存在しない場合、ユーザがアクセス権限を持っていない場合はエラーを返す
     if not doc:
@@ -356,6 +494,160 @@ def get_generated_doc_api(doc_id):
     return doc, 200
 
 
+# 指定した生成ドキュメントの生成状況のみを取得するAPI
+# (生成中のポーリング用に、章のコンテンツを含めずにステータスと章数のみを返す)
+@app.route("/api/generated/<doc_id>/status", methods=["GET"])
+def get_generated_doc_status_api(doc_id):
+
+    # ログインユーザ情報を取得する
+    user_id, _ = get_user_info()
+
+    # 生成状況に必要なフィールドのみを Cosmos DB から取得する
+    query = """
+        SELECT
+            c.owner_user_id,
+            c.status,
+            ARRAY_LENGTH(c.chapter_titles) AS chapter_count,
+            ARRAY_LENGTH(c.generated_contents) AS generated_count
+        FROM c
+        WHERE
+            c.id = @doc_id
+            AND c.type = "generated"
+    """
+    parameters = [{"name": "@doc_id", "value": doc_id}]
+    docs = docs_cosmos_container.query_items(query, parameters, partition_key=user_id)
+
+    # ドキュメントが存在しない場合、ユーザがアクセス権限を持っていない場合はエラーを返す
+    if not docs:
+        return "", 404
+    elif docs[0]["owner_user_id"] != user_id:
+        return "", 403
+
+    # 生成状況を返す
+    doc = docs[0]
+    return {
+        "id": doc_id,
+        "status": doc["status"],
+        "chapter_count": doc.get("chapter_count", 0),
+        "generated_count": doc.get("generated_count", 0),
+    }, 200
+
+
+# 指定した生成ドキュメントのうち、指定したインデックス以降に生成された章のコンテンツのみを取得するAPI
+@app.route("/api/generated/<doc_id>/chapters", methods=["GET"])
+def get_generated_doc_chapters_api(doc_id):
+
+    # クエリパラメータから取得を開始する章のインデックスを取得する
+    start = request.args.get("from", 0, type=int)
+    if start < 0:
+        return "", 400
+
+    # ログインユーザ情報を取得する
+    user_id, _ = get_user_info()
+
+    # 指定したインデックス以降の章のコンテンツのみを Cosmos DB から取得する
+    query = """
+        SELECT
+            c.owner_user_id,
+            c.status,
+            ARRAY_SLICE(c.generated_contents, @start) AS generated_contents
+        FROM c
+        WHERE
+            c.id = @doc_id
+            AND c.type = "generated"
+    """
+    parameters = [{"name": "@doc_id", "value": doc_id}, {"name": "@start", "value": start}]
+    docs = docs_cosmos_container.query_items(query, parameters, partition_key=user_id)
+
+    # ドキュメントが存在しない場合、ユーザがアクセス権限を持っていない場合はエラーを返す
+    if not docs:
+        return "", 404
+    elif docs[0]["owner_user_id"] != user_id:
+        return "", 403
+
+    # 取得した章のコンテンツを返す
+    doc = docs[0]
+    return {
+        "id": doc_id,
+        "status": doc["status"],
+        "from": start,
+        "generated_contents": doc.get("generated_contents", []),
+    }, 200
+
+
+# 指定した生成ドキュメントの生成の進捗(ステータスの変化と生成が完了した章)を Server-Sent Events で配信するAPI
+@app.route("/api/generated/<doc_id>/events", methods=["GET"])
+def stream_generated_doc_events_api(doc_id):
+
+    # ログインユーザ情報を取得する
+    user_id, _ = get_user_info()
+
+    # ドキュメントの所有者とステータスのみを Cosmos DB から取得する
+    def get_doc():
+        query = """
+            SELECT
+                c.owner_user_id,
+                c.status
+            FROM c
+            WHERE
+                c.id = @doc_id
+                AND c.type = "generated"
+        """
+        parameters = [{"name": "@doc_id", "value": doc_id}]
+        docs = docs_cosmos_container.query_items(query, parameters, partition_key=user_id)
+        return docs[0] if docs else None
+
+    # ドキュメントが存在しない場合、ユーザがアクセス権限を持っていない場合はエラーを返す
+    doc = get_doc()
+    if not doc:
+        return "", 404
+    elif doc["owner_user_id"] != user_id:
+        return "", 403
+
+    # 同時接続数が上限に達している場合は、ストリームを開始せずにエラーを返す
+    if not sse_streams.acquire(blocking=False):
+        return "", 503, {"Retry-After": str(int(SSE_MAX_DURATION))}
+
+    # 再接続時は、最後に受信したイベントの ID (進捗イベントの読み込み位置)以降のイベントから配信する
+    offset = request.headers.get("Last-Event-ID", 0, type=int)
+
+    def generate_events(offset: int, status: str):
+        # 最大接続時間でストリームを終了した後、ブラウザがすぐに再接続するよう再接続の間隔(ミリ秒)を指定する
+        yield f"retry: {SSE_RECONNECT_INTERVAL}\n\n"
+        started_at = last_sent_at = time.monotonic()
+        while time.monotonic() - started_at < SSE_MAX_DURATION:
+            events, offset = progress_channel.read(doc_id, offset)
+            for event_offset, event in events:
+                yield f"id: {event_offset}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event["type"] == "status" and event["status"] in ["processed", "failed"]:
+                    return
+            if events:
+                last_sent_at = time.monotonic()
+
+            # 生成が終了しており、未配信の進捗イベントがない場合は、ステータスのみを配信して終了する
+            # (終了のイベントを受信した後に再接続した場合や、終了のイベントが記録されなかった場合)
+            if not events and status in ["processed", "failed"]:
+                yield f"event: status\ndata: {json.dumps({'type': 'status', 'status': status})}\n\n"
+                return
+
+            # 接続が切断されないよう、一定時間イベントがない場合はコメント行を送信する
+            # (合わせて Cosmos DB のステータスを確認し、終了のイベントが記録されないまま生成が終了した場合に検知する)
+            if time.monotonic() - last_sent_at >= SSE_HEARTBEAT_INTERVAL:
+                yield ": heartbeat\n\n"
+                last_sent_at = time.monotonic()
+                latest_doc = get_doc()
+                if not latest_doc:
+                    return
+                status = latest_doc["status"]
+            time.sleep(SSE_POLL_INTERVAL)
+
+    # ストリームが終了した時点(クライアントの切断を含む)で同時接続数の枠を解放する
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(stream_with_context(generate_events(offset, doc["status"])), mimetype="text/event-stream", headers=headers)
+    response.call_on_close(sse_streams.release)
+    return response
+
+
 # ドキュメントの生成を開始するAPI
 @app.route("/api/generated", methods=["POST"])
 def request_generating_doc_api():
@@ -366,18 +658,25 @@ def request_generating_doc_api():
     ref_doc_id = request.json["referenceDocId"]
     group_id = request.json["sourceGroupId"]
 
-    # Cosmos DB に格納されているドキュメントとグループを取得する
-    doc = docs_cosmos_container.get_item(ref_doc_id)
-    group = groups_cosmos_container.get_item(group_id)
+    # ログインユーザ情報を取得する
+    user_id, _ = get_user_info()
+
+    # Cosmos DB に格納されているドキュメントとグループを並列に取得する(ログインユーザが所有するもののみ)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        doc_future = executor.submit(docs_cosmos_container.get_item, ref_doc_id, user_id)
+        group_future = executor.submit(groups_cosmos_container.get_item, group_id, user_id)
+        doc, group = doc_future.result(), group_future.result()
     if not doc or not group:
         return "", 400
 
+    # ログインユーザが所有するドキュメントとグループかを確認する
+    # (移行期間中は、全ユーザのアイテムが格納されている移行前のパーティションからも読み込まれるため)
+    if doc["owner_user_id"] != user_id or group["owner_user_id"] != user_id:
+        return "", 403
+
     # ドキュメントのIDを生成する
     doc_id = str(uuid.uuid4())
 
-    # ログインユーザ情報を取得する
-    user_id, _ = get_user_info()
-
     # リファレンスドキュメントのデータを Cosmos DB に保存する
     doc = {
         "id": doc_id,
@@ -402,17 +701,14 @@ def delete_generated_doc_api(doc_id):
     # ログインユーザ情報を取得する
     user_id, _ = get_user_info()
 
-    # 指定したドキュメントが存在するかを確認する
-    doc = docs_cosmos_container.get_item(doc_id)
-    if not doc:
+    # Cosmos DB からドキュメントを削除する
+    # (ログインユーザのパーティションのみを対象とするため、他のユーザのドキュメントは存在しないものとして扱う)
+    if not docs_cosmos_container.delete_item(doc_id, partition_key=user_id):
         return "", 404
 
-    # ログインユーザが削除操作ができるかを確認する
-    if doc["owner_user_id"] != user_id:
-        return "", 403
-
-    # Cosmos DB からドキュメントを削除する
-    docs_cosmos_container.delete_item(doc_id)
+    # 生成の進捗イベントと、ダウンロード用に作成したWordファイルを Azure Blob Storage から削除する
+    progress_channel.reset(doc_id)
+    blob_container.delete_blob(f"{doc_id}.docx")
 
     return "", 204
 
@@ -425,7 +721,7 @@ def get_generated_doc_download_url_api(doc_id):
     user_id, _ = get_user_info()
 
     # ダウンロード対象のドキュメントを Cosmos DB から取得する
-    doc = docs_cosmos_container.get_item(doc_id)
+    doc = docs_cosmos_container.get_item(doc_id, partition_key=user_id)
 
     # ドキュメントが存在するかを確認する
     if not doc:
@@ -466,6 +762,23 @@ def get_generated_doc_download_url_api(doc_id):
     return download_url, 200
 
 
+# 一覧を取得するクエリを実行し、クエリパラメータ limit が指定された場合はページ単位で結果を返す
+# (continuationToken には前のページのレスポンスに含まれる継続トークンを指定する)
+def query_list(container: CosmosContainer, query: str, parameters: list[dict], user_id: str):
+    limit = request.args.get("limit", type=int)
+    if limit is None:
+        return container.query_items(query, parameters, partition_key=user_id), 200
+    if limit <= 0 or limit > LIST_MAX_PAGE_SIZE:
+        return "", 400
+
+    try:
+        continuation_token = request.args.get("continuationToken")
+        items, continuation_token = container.query_page(query, parameters, partition_key=user_id, page_size=limit, continuation_token=continuation_token)
+    except ValueError:
+        return "", 400
+    return {"items": items, "continuationToken": continuation_token}, 200
+
+
 # ログイン中のユーザ情報を取得するAPI
 @app.route("/api/user", methods=["GET"])
 def get_user_info_api():
@@ -500,5 +813,6 @@ def get_user_info():
     return (user_id, user_name)
 
 
+# 開発用サーバで起動する(本番環境では gunicorn.conf.py の設定で Gunicorn から起動する)
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=80)
@@ -0,0 +1,245 @@
+import os
+import json
+import uuid
+import argparse
+from datetime import datetime, timedelta
+from utils.cosmos import CosmosContainer, COSMOS_OFFLOAD_THRESHOLD
+
+# Web アプリと Azure Functions が Azure Blob Storage に退避するフィールド
+OFFLOAD_FIELDS = ["content", "analysis_result", "chapter_contents"]
+
+# webapp/app.py の一覧取得APIと同じ形のクエリ
+DOCS_LIST_QUERIES = {
+    "list_reference": (
+        'SELECT c.id, c.name, c.status, c.created_at, c.file_extention FROM c WHERE c.owner_user_id = @user_id AND c.type = "reference" ORDER BY c.created_at DESC',
+        [],
+    ),
+    "list_source": (
+        'SELECT c.id, c.name, c.status, c.created_at, c.file_extention FROM c WHERE c.owner_user_id = @user_id AND c.group_id = @group_id AND c.type = "source" ORDER BY c.created_at DESC',
+        ["@group_id"],
+    ),
+    "list_generated": (
+        'SELECT c.id, c.reference_doc_name, c.source_group_name, c.status, c.created_at FROM c WHERE c.owner_user_id = @user_id AND c.type = "generated" ORDER BY c.created_at DESC',
+        [],
+    ),
+}
+GROUPS_LIST_QUERIES = {
+    "list_group": (
+        "SELECT c.id, c.name, c.created_at FROM c WHERE c.owner_user_id = @user_id ORDER BY c.created_at DESC",
+        [],
+    ),
+}
+
+
+# Azure Cosmos DB の書き込みと一覧取得クエリで消費される RU を計測する
+# インデックスポリシーの適用前後で実行し、結果を比較する
+# 計測用のアイテムは専用のユーザ(パーティション)に作成し、計測後に削除する
+#
+# 使い方:
+#   python benchmark_cosmos_ru.py --output before.json
+#   (cosmos/*-indexing-policy.json を適用し、インデックスの再構築が完了するのを待つ)
+#   python benchmark_cosmos_ru.py --baseline before.json
+def main():
+    parser = argparse.ArgumentParser(description="Cosmos DB の書き込みと一覧取得クエリの RU を計測する")
+    parser.add_argument("--items", type=int, default=50, help="種類ごとに作成するアイテム数")
+    parser.add_argument("--payload-kb", type=int, default=32, help="ドキュメントのコンテンツ(抽出したテキスト)のサイズ(KB)")
+    parser.add_argument("--page-size", type=int, default=20, help="一覧取得クエリのページサイズ")
+    parser.add_argument("--output", help="計測結果を保存する JSON ファイル")
+    parser.add_argument("--baseline", help="比較対象とする計測結果の JSON ファイル")
+    args = parser.parse_args()
+
+    # アイテムは Web アプリと Azure Functions が書き込むものと同じ形(閾値を超えるフィールドは Blob への参照)で書き込む
+    docs_container = CosmosContainer(container_name=os.getenv("AZURE_COSMOS_DOCS_CONTAINER_NAME"), partition_key_field="owner_user_id", legacy_partition_fallback=False)
+    groups_container = CosmosContainer(container_name=os.getenv("AZURE_COSMOS_GROUPS_CONTAINER_NAME"), partition_key_field="owner_user_id", legacy_partition_fallback=False)
+    for container in [docs_container, groups_container]:
+        print_index_transformation_progress(container)
+
+    user_id = f"benchmark-{uuid.uuid4()}"
+    group_id = str(uuid.uuid4())
+    docs, groups = create_items(user_id, group_id, args.items, args.payload_kb * 1024)
+
+    results = {"write": {}, "query": {}}
+    try:
+        for doc_type in ["reference", "source", "generated"]:
+            results["write"][doc_type] = measure_writes(docs_container, [doc for doc in docs if doc["type"] == doc_type])
+        results["write"]["group"] = measure_writes(groups_container, groups)
+
+        parameters = {"@user_id": user_id, "@group_id": group_id}
+        for name, (query, params) in DOCS_LIST_QUERIES.items():
+            results["query"][name] = measure_query(docs_container, query, ["@user_id"] + params, parameters, user_id, args.page_size)
+        for name, (query, params) in GROUPS_LIST_QUERIES.items():
+            results["query"][name] = measure_query(groups_container, query, ["@user_id"] + params, parameters, user_id, args.page_size)
+    finally:
+        for doc in docs:
+            docs_container.container.delete_item(item=doc["id"], partition_key=user_id)
+        for group in groups:
+            groups_container.container.delete_item(item=group["id"], partition_key=user_id)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+# 計測用のアイテムを生成する(フィールドの構成は Web アプリと Azure Functions が作成するアイテムに合わせる)
+# - リファレンスドキュメント: テキスト抽出・章タイトル抽出・章の内容抽出を終えたもの
+# - 情報源ドキュメント: テキスト抽出・インデックス登録を終えたもの
+# - 生成ドキュメント: 生成を終えたもの
+def create_items(user_id: str, group_id: str, count: int, payload_size: int, chapter_count: int = 10) -> tuple[list[dict], list[dict]]:
+    content = ("lorem ipsum dolor sit amet " * (payload_size // 27 + 1))[:payload_size]
+    chapter_size = len(content) // chapter_count
+    chapter_titles = [f"{j + 1}. chapter title {j + 1}" for j in range(chapter_count)]
+    chapter_contents = [content[j * chapter_size : (j + 1) * chapter_size] for j in range(chapter_count)]
+    analysis_result = create_analysis_result(content)
+
+    created_at = datetime.now()
+    docs, groups = [], []
+    for i in range(count):
+        timestamp = (created_at - timedelta(seconds=i)).isoformat()
+        ref_doc = {
+            "id": str(uuid.uuid4()),
+            "owner_user_id": user_id,
+            "name": f"reference-{i}.pdf",
+            "file_extention": "pdf",
+            "status": "processed",
+            "created_at": timestamp,
+            "type": "reference",
+            "content": content,
+            "analysis_result": analysis_result,
+            "chapter_titles": chapter_titles,
+            "chapter_contents": chapter_contents,
+        }
+        src_doc = {
+            "id": str(uuid.uuid4()),
+            "owner_user_id": user_id,
+            "name": f"source-{i}.pdf",
+            "file_extention": "pdf",
+            "status": "processed",
+            "created_at": timestamp,
+            "type": "source",
+            "group_id": group_id,
+            "content": content,
+            "analysis_result": analysis_result,
+        }
+        generated_doc = {
+            "id": str(uuid.uuid4()),
+            "owner_user_id": user_id,
+            "type": "generated",
+            "reference_doc_id": ref_doc["id"],
+            "reference_doc_name": ref_doc["name"],
+            "source_group_id": group_id,
+            "source_group_name": "benchmark",
+            "status": "processed",
+            "created_at": timestamp,
+            "chapter_titles": chapter_titles,
+            "generated_contents": chapter_contents,
+        }
+        docs += [offload_fields(doc) for doc in [ref_doc, src_doc, generated_doc]]
+        groups.append({"id": str(uuid.uuid4()), "owner_user_id": user_id, "name": f"group-{i}", "created_at": timestamp})
+    return docs, groups
+
+
+# Document Intelligence の解析結果(AnalyzeResult.as_dict())と同じ構成のデータを生成する
+def create_analysis_result(content: str, words_per_page: int = 500) -> dict:
+    words, offset = [], 0
+    for word in content.split(" "):
+        polygon = [1.0, 1.0, 1.5, 1.0, 1.5, 1.2, 1.0, 1.2]
+        words.append({"content": word, "polygon": polygon, "confidence": 0.99, "span": {"offset": offset, "length": len(word)}})
+        offset += len(word) + 1
+
+    pages, paragraphs = [], []
+    for page_number, start in enumerate(range(0, len(words), words_per_page), start=1):
+        page_words = words[start : start + words_per_page]
+        page_span = {"offset": page_words[0]["span"]["offset"], "length": sum(w["span"]["length"] + 1 for w in page_words)}
+        lines = []
+        for k in range(0, len(page_words), 10):
+            line_words = page_words[k : k + 10]
+            line_content = " ".join(w["content"] for w in line_words)
+            line_span = {"offset": line_words[0]["span"]["offset"], "length": len(line_content)}
+            lines.append({"content": line_content, "polygon": line_words[0]["polygon"], "spans": [line_span]})
+        pages.append({"pageNumber": page_number, "angle": 0, "width": 8.5, "height": 11, "unit": "inch", "words": page_words, "lines": lines, "spans": [page_span]})
+        paragraphs.append({"content": " ".join(l["content"] for l in lines), "boundingRegions": [{"pageNumber": page_number, "polygon": lines[0]["polygon"]}], "spans": [page_span]})
+
+    return {"apiVersion": "2024-02-29-preview", "modelId": "prebuilt-layout", "content": content, "pages": pages, "paragraphs": paragraphs, "tables": []}
+
+
+# Web アプリと Azure Functions と同様に、サイズの大きいフィールドを Azure Blob Storage への参照に置き換える
+# (RU の計測には Cosmos DB に格納される形のみが必要なため、Blob へのアップロードは行わない)
+def offload_fields(item: dict) -> dict:
+    item = dict(item)
+    for field in OFFLOAD_FIELDS:
+        value = item.get(field)
+        if value is None:
+            continue
+        size = len(json.dumps(value, ensure_ascii=False).encode())
+        if size > COSMOS_OFFLOAD_THRESHOLD:
+            item[field] = {"blob_name": f"cosmos-offload/{item['id']}/{field}.json.gz", "size": size}
+    return item
+
+
+# アイテムを1件ずつ書き込み、1件あたりの平均 RU を返す
+def measure_writes(container: CosmosContainer, items: list[dict]) -> float:
+    charges = []
+    for item in items:
+        item = {**item, container.partition_key_path: container.get_partition_key(item)}
+        container.container.upsert_item(item)
+        charges.append(get_request_charge(container))
+    return sum(charges) / len(charges) if charges else 0.0
+
+
+# 一覧取得クエリの先頭ページと全ページの取得で消費される RU を返す
+def measure_query(container: CosmosContainer, query: str, param_names: list[str], parameters: dict, user_id: str, page_size: int) -> dict:
+    pages = container.container.query_items(
+        query=query,
+        parameters=[{"name": name, "value": parameters[name]} for name in param_names],
+        partition_key=user_id,
+        max_item_count=page_size,
+    ).by_page()
+
+    charges = []
+    for page in pages:
+        list(page)
+        charges.append(get_request_charge(container))
+    return {"first_page": charges[0] if charges else 0.0, "all_pages": sum(charges), "pages": len(charges)}
+
+
+# 直前のリクエストで消費された RU をレスポンスヘッダから取得する
+def get_request_charge(container: CosmosContainer) -> float:
+    headers = container.container.client_connection.last_response_headers
+    return float(headers.get("x-ms-request-charge", 0))
+
+
+# インデックスポリシーの変更後、インデックスの再構築中は計測結果が安定しないため、進捗を表示する
+def print_index_transformation_progress(container: CosmosContainer):
+    container.container.read(populate_quota_info=True)
+    headers = container.container.client_connection.last_response_headers
+    progress = headers.get("x-ms-documentdb-collection-index-transformation-progress")
+    print(f"{container.container.id}: index transformation progress {progress}%")
+    if progress is not None and int(progress) < 100:
+        print("  warning: index transformation is in progress, results may not reflect the current indexing policy")
+
+
+# 計測結果を表示する(比較対象がある場合は、比較対象からの変化率も表示する)
+def print_results(results: dict, baseline: dict = None):
+    rows = [(f"write {name} (RU/item)", ("write", name, None)) for name in results["write"]]
+    for name in results["query"]:
+        rows.append((f"{name} first page (RU)", ("query", name, "first_page")))
+        rows.append((f"{name} all pages (RU)", ("query", name, "all_pages")))
+
+    for label, (kind, name, key) in rows:
+        value = results[kind][name] if key is None else results[kind][name][key]
+        line = f"{label:<40} {value:>10.2f}"
+        if baseline and name in baseline.get(kind, {}):
+            before = baseline[kind][name] if key is None else baseline[kind][name][key]
+            change = (value - before) / before * 100 if before else 0.0
+            line += f" (before {before:>10.2f}, {change:+.1f}%)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
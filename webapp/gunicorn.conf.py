@@ -0,0 +1,44 @@
+import os
+
+# 本番環境では Flask の開発用サーバではなく、Gunicorn のマルチワーカー(スレッド)構成で API を提供する
+bind = os.getenv("WEB_BIND", "0.0.0.0:80")
+
+
+# コンテナに割り当てられた CPU 数を取得する
+# (multiprocessing.cpu_count() はホストの CPU 数を返すため、cgroup の CPU 制限と CPU アフィニティを考慮する)
+def get_cpu_limit() -> int:
+    cpu_limit = len(os.sched_getaffinity(0))
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpu_limit = min(cpu_limit, int(quota) // int(period))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpu_limit = min(cpu_limit, quota // period)
+        except (OSError, ValueError):
+            pass
+    return max(1, cpu_limit)
+
+
+# ワーカープロセス数とワーカーあたりのスレッド数
+# Cosmos DB, Blob Storage, AI Search への I/O 待ちで他のリクエストが止まらないよう、スレッドで並行処理する
+# (生成の進捗を配信する Server-Sent Events の接続は、接続中はスレッドを1つ占有する。
+#  他のリクエストを処理するスレッドが残るよう、同時接続数はワーカーあたり SSE_MAX_STREAMS (既定はスレッド数の1/4)までに制限する)
+# (各ワーカーの Azure SDK のコネクションプールは、スレッド数以上の大きさになる(utils/http.py の HTTP_POOL_MAXSIZE))
+workers = int(os.getenv("WEB_CONCURRENCY", get_cpu_limit() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 32))
+
+# Word 変換(pandoc)や大きなファイルのアップロードを考慮したタイムアウト(秒)
+timeout = int(os.getenv("WEB_TIMEOUT", 300))
+
+accesslog = "-"
+errorlog = "-"
@@ -0,0 +1,72 @@
+import time
+import argparse
+import threading
+import statistics
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Web API に対して並行にリクエストを送信し、1秒あたりのリクエスト数(RPS)とレイテンシを計測する
+#
+# 例) Flask の開発用サーバ(python app.py)と Gunicorn(gunicorn app:app)のそれぞれで起動して計測し、結果を比較する
+#   python loadtest.py --url http://localhost/api/reference --concurrency 32 --duration 30
+#
+# 計測結果の例(1 vCPU、Cosmos DB の応答時間を模擬したフェイクで /api/reference を計測、負荷生成も同じ CPU で実行)
+#   応答時間 30ms / 32並列:  開発用サーバ 363 RPS (p95 144ms), Gunicorn 3ワーカー×32スレッド 405 RPS (p95 131ms)
+#   応答時間 200ms / 64並列: 開発用サーバ 282 RPS (p95 266ms), Gunicorn 3ワーカー×32スレッド 277 RPS (p95 277ms)
+#   応答時間 200ms / 64並列: Gunicorn 3ワーカー×16スレッド(同時処理数の上限 48) 231 RPS (p95 389ms)
+#   (この環境では開発用サーバと Gunicorn のスループットに明確な差はない。実際のネットワークや TLS のコストは含まれないため、
+#    構成を比較する場合はデプロイした環境で計測する)
+def main():
+    parser = argparse.ArgumentParser(description="Web API の簡易負荷試験")
+    parser.add_argument("--url", required=True, help="リクエストを送信する URL")
+    parser.add_argument("--method", default="GET", help="HTTP メソッド")
+    parser.add_argument("--concurrency", type=int, default=16, help="並行して送信するクライアント数")
+    parser.add_argument("--duration", type=float, default=30, help="計測する時間(秒)")
+    parser.add_argument("--principal", default=None, help="X-Ms-Client-Principal ヘッダーに設定する値")
+    args = parser.parse_args()
+
+    headers = {"X-Ms-Client-Principal": args.principal} if args.principal else {}
+    deadline = time.monotonic() + args.duration
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    # 各クライアントは計測時間が終わるまで、レスポンスを受け取り次第次のリクエストを送信する
+    def run_client():
+        nonlocal errors
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                resp = session.request(args.method, args.url, headers=headers, timeout=60)
+                ok = resp.status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.monotonic() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors += 1
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in range(args.concurrency):
+            executor.submit(run_client)
+    total_time = time.monotonic() - started_at
+
+    # 計測結果を出力する
+    if not latencies:
+        print("no requests completed")
+        return
+    latencies.sort()
+    print(f"requests:    {len(latencies)} ({errors} errors)")
+    print(f"duration:    {total_time:.1f} s")
+    print(f"rps:         {len(latencies) / total_time:.1f}")
+    print(f"latency p50: {statistics.median(latencies) * 1000:.0f} ms")
+    print(f"latency p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
+    print(f"latency max: {latencies[-1] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
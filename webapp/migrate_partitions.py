@@ -0,0 +1,68 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from utils.cosmos import CosmosContainer, LEGACY_PARTITION_KEY
+
+# 移行中に Azure Functions で処理中のドキュメントのステータス
+# (アイテムを新しいパーティションに書き込むと変更フィードにより処理が再実行されるため、既定では移行しない)
+IN_PROGRESS_STATUSES = ["uploaded", "text_extracted", "chapter_titles_extracted", "requested", "generating"]
+
+# Cosmos DB がアイテムに付与するシステムプロパティ
+SYSTEM_PROPERTIES = ["_rid", "_self", "_etag", "_attachments", "_ts"]
+
+
+# 単一のパーティション("0")に格納されているアイテムを、所有ユーザのIDをパーティションキーとするパーティションへ移行する
+# 移行中は Web アプリと Azure Functions の AZURE_COSMOS_LEGACY_PARTITION_FALLBACK を true にすると、
+# 移行前のパーティションも参照されるため、サービスを停止せずに実行できる(移行が完了したら false に戻す)
+#
+# 使い方:
+#   python migrate_partitions.py --dry-run
+#   python migrate_partitions.py --concurrency 16
+def main():
+    parser = argparse.ArgumentParser(description="Cosmos DB のアイテムを所有ユーザ単位のパーティションへ移行する")
+    parser.add_argument("--concurrency", type=int, default=8, help="並列に移行するアイテム数")
+    parser.add_argument("--include-in-progress", action="store_true", help="処理中のドキュメントも移行する")
+    parser.add_argument("--dry-run", action="store_true", help="移行対象のアイテム数のみを表示する")
+    args = parser.parse_args()
+
+    container_names = [os.getenv("AZURE_COSMOS_DOCS_CONTAINER_NAME"), os.getenv("AZURE_COSMOS_GROUPS_CONTAINER_NAME")]
+    for container_name in container_names:
+        container = CosmosContainer(container_name=container_name, partition_key_field="owner_user_id", legacy_partition_fallback=False)
+        migrate_container(container, args.concurrency, args.include_in_progress, args.dry_run)
+
+
+# 指定したコンテナの移行前のパーティションに格納されているアイテムを移行する
+def migrate_container(container: CosmosContainer, concurrency: int, include_in_progress: bool, dry_run: bool):
+    items = container.query_items("SELECT * FROM c", partition_key=LEGACY_PARTITION_KEY)
+
+    # 所有ユーザが設定されていないアイテムと、処理中のドキュメントは移行しない
+    targets, skipped = [], []
+    for item in items:
+        if not item.get("owner_user_id"):
+            skipped.append((item["id"], "no owner_user_id"))
+        elif not include_in_progress and item.get("status") in IN_PROGRESS_STATUSES:
+            skipped.append((item["id"], f"in progress ({item['status']})"))
+        else:
+            targets.append(item)
+
+    print(f"{container.container.id}: {len(targets)} items to migrate, {len(skipped)} items skipped")
+    for id, reason in skipped:
+        print(f"  skipped: {id} ({reason})")
+    if dry_run:
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda item: migrate_item(container, item), targets))
+    print(f"{container.container.id}: migrated {len(targets)} items")
+
+
+# アイテムを新しいパーティションに書き込んだ後、移行前のパーティションから削除する
+# (Azure Blob Storage に退避したフィールドは同じ Blob を参照し続けるため、移行前のアイテムは Cosmos DB からのみ削除する)
+def migrate_item(container: CosmosContainer, item: dict):
+    new_item = {k: v for k, v in item.items() if k not in SYSTEM_PROPERTIES}
+    container.upsert_item(new_item)
+    container.container.delete_item(item=item["id"], partition_key=LEGACY_PARTITION_KEY)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,30 @@
 import os
 import re
 import json
+import base64
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timezone, timedelta
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import TokenCredential
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from azure.core.pipeline.transport import HttpTransport
+from azure.storage.blob import BlobServiceClient, BlobBlock, generate_blob_sas, BlobSasPermissions
 
 AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
 AZURE_STORAGE_CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
 AZURE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 
+# SAS の生成に使用するユーザー委任キーの有効期間と、有効期限のどれだけ前から新しいキーを取得するか(秒)
+# (ユーザー委任キーの有効期間は最大7日間)
+AZURE_STORAGE_DELEGATION_KEY_LIFETIME = int(os.getenv("AZURE_STORAGE_DELEGATION_KEY_LIFETIME", 24 * 60 * 60))
+AZURE_STORAGE_DELEGATION_KEY_REFRESH_MARGIN = int(os.getenv("AZURE_STORAGE_DELEGATION_KEY_REFRESH_MARGIN", 60 * 60))
+DELEGATION_KEY_MAX_LIFETIME = 7 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
 
 class BlobContainer:
 
@@ -19,22 +34,31 @@ class BlobContainer:
         container_name: str = None,
         credential: TokenCredential = DefaultAzureCredential(),
         connection_string: str = None,
+        transport: HttpTransport = None,
     ):
         account_name = account_name or AZURE_STORAGE_ACCOUNT_NAME
         container_name = container_name or AZURE_STORAGE_CONTAINER_NAME
         self.connection_string = connection_string or AZURE_CONNECTION_STRING
         if self.connection_string:
-            self.blob_client = BlobServiceClient.from_connection_string(connection_string)
+            self.blob_client = BlobServiceClient.from_connection_string(self.connection_string, transport=transport)
+            account_key = re.search(r"AccountKey=([^;]+)", self.connection_string)
+            self.account_key = account_key.group(1) if account_key else None
         else:
             self.credential = credential
             self.blob_client = BlobServiceClient(
                 account_url=f"https://{account_name}.blob.core.windows.net",
                 credential=self.credential,
+                transport=transport,
             )
         self.container_client = self.blob_client.get_container_client(container_name)
         if not self.container_client.exists():
             self.container_client.create_container()
 
+        # SAS の生成に使用するユーザー委任キーを (キー, 有効期限) としてキャッシュする
+        # (キーの取得は1スレッドずつ行い、有効なキーがある間は取得中でも待たずにそのキーを使用する)
+        self.delegation_key = None
+        self.delegation_key_lock = threading.Lock()
+
     def upload_json(self, blob_name: str, data: object, overwrite: bool = True):
         """
         JSONデータを指定された名前のBlobとしてアップロードします。
@@ -94,18 +118,79 @@ class BlobContainer:
         """
         self.container_client.upload_blob(name=blob_name, data=data, overwrite=overwrite)
 
-    def download_bytes(self, blob_name: str) -> bytes:
+    def upload_stream(self, blob_name: str, stream, block_size: int = 4 * 1024 * 1024, max_concurrency: int = 4) -> tuple[str, str]:
+        """
+        ストリームを固定サイズのブロックに分割し、ブロックBlobとして並列にステージングしてアップロードします。
+        同時にメモリに保持するブロックは最大 max_concurrency + 1 個のため、ファイル全体をメモリに読み込みません。
+        読み込んだブロックから、アップロードした内容のSHA-256ハッシュ値も計算します。
+
+        Args:
+            blob_name (str): アップロードするBlobの名前。
+            stream: アップロードするデータを読み込むストリーム(read メソッドを持つオブジェクト)。
+            block_size (int, optional): 1ブロックのサイズ(バイト)。デフォルトは4MiB。
+            max_concurrency (int, optional): 並列にステージングするブロックの最大数。デフォルトは4。
+
+        Returns:
+            tuple[str, str]: アップロードした内容のSHA-256ハッシュ値(16進数文字列)と、BlobのETag。
+        """
+        blob = self.container_client.get_blob_client(blob_name)
+        block_ids = []
+        sha256 = hashlib.sha256()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = set()
+            while True:
+                data = stream.read(block_size)
+                if not data:
+                    break
+                sha256.update(data)
+                block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+                block_ids.append(block_id)
+                pending.add(executor.submit(blob.stage_block, block_id, data))
+
+                # ステージング中のブロック数が上限に達したら、いずれかが完了するまで次のブロックを読み込まない
+                if len(pending) >= max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    [f.result() for f in done]
+            [f.result() for f in pending]
+
+        # ステージングしたブロックをコミットしてBlobを確定する
+        result = blob.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids])
+        return sha256.hexdigest(), result["etag"]
+
+    def append_bytes(self, blob_name: str, data: bytes):
+        """
+        バイトデータを指定された名前の追加Blobの末尾に追記します。Blobが存在しない場合は作成します。
+
+        Args:
+            blob_name (str): 追記する追加Blobの名前。
+            data (bytes): 追記するバイトデータ。
+
+        Returns:
+            None
+        """
+        blob = self.container_client.get_blob_client(blob_name)
+        try:
+            blob.append_block(data)
+        except ResourceNotFoundError:
+            try:
+                blob.create_append_blob(if_none_match="*")
+            except ResourceExistsError:
+                pass
+            blob.append_block(data)
+
+    def download_bytes(self, blob_name: str, offset: int = None) -> bytes:
         """
         指定された名前のBlobからバイトデータをダウンロードします。
 
         Args:
             blob_name (str): ダウンロードするBlobの名前。
+            offset (int, optional): ダウンロードを開始する位置(バイト)。指定しない場合は先頭から。
 
         Returns:
             bytes: ダウンロードしたバイトデータ。
         """
         blob = self.container_client.get_blob_client(blob_name)
-        return blob.download_blob().readall()
+        return blob.download_blob(offset=offset).readall()
 
     def download_string(self, blob_name: str) -> str:
         """
@@ -131,6 +216,34 @@ class BlobContainer:
         """
         return json.loads(self.download_string(blob_name))
 
+    def get_sha256(self, blob_name: str) -> tuple[str, str]:
+        """
+        指定された名前のBlobの内容のSHA-256ハッシュ値を、Blob全体をメモリに読み込まずに計算します。
+
+        Args:
+            blob_name (str): ハッシュ値を計算するBlobの名前。
+
+        Returns:
+            tuple[str, str]: SHA-256ハッシュ値(16進数文字列)と、ハッシュ値を計算した時点のBlobのETag。
+        """
+        sha256 = hashlib.sha256()
+        downloader = self.container_client.get_blob_client(blob_name).download_blob()
+        for chunk in downloader.chunks():
+            sha256.update(chunk)
+        return sha256.hexdigest(), downloader.properties.etag
+
+    def get_etag(self, blob_name: str) -> str:
+        """
+        指定された名前のBlobのETagを、内容をダウンロードせずに取得します。
+
+        Args:
+            blob_name (str): ETagを取得するBlobの名前。
+
+        Returns:
+            str: BlobのETag。
+        """
+        return self.container_client.get_blob_client(blob_name).get_blob_properties().etag
+
     def list_blobs(self):
         """
         コンテナ内のすべてのBlobをリストアップします。
@@ -140,6 +253,18 @@ class BlobContainer:
         """
         return [b for b in self.container_client.list_blobs()]
 
+    def exists(self, blob_name: str) -> bool:
+        """
+        指定された名前のBlobが存在するかを確認します。
+
+        Args:
+            blob_name (str): 確認するBlobの名前。
+
+        Returns:
+            bool: Blobが存在する場合はTrue。
+        """
+        return self.container_client.get_blob_client(blob_name).exists()
+
     def delete_blob(self, blob_name):
         """
         指定された名前のBlobを削除します。
@@ -156,6 +281,8 @@ class BlobContainer:
     def get_url_with_sas(self, blob_name: str, read: bool = True, write: bool = True, expiry: int = 300):
         """
         SASトークンを使用したBlobのURLを取得します。
+        接続文字列を使用する場合はアカウントキーで署名するため、ネットワークへのアクセスは発生しません。
+        それ以外の場合はキャッシュしたユーザー委任キーで署名し、キーの有効期限が近づくとバックグラウンドで新しいキーを取得します。
 
         Args:
             blob_name (str): SASトークンを取得するBlobの名前。
@@ -166,33 +293,64 @@ class BlobContainer:
         Returns:
             str: SASトークンを含むBlobのURL。
         """
-
-        # ユーザー委任キーを生成する
-        key_start_time = datetime.now(timezone.utc)
-        key_expiry_time = key_start_time + timedelta(seconds=expiry)
-        user_delegation_key = self.blob_client.get_user_delegation_key(key_start_time=key_start_time, key_expiry_time=key_expiry_time)
+        blob_url = f"https://{self.blob_client.account_name}.blob.core.windows.net/{self.container_client.container_name}/{blob_name}"
+        sas_expiry = datetime.now(timezone.utc) + timedelta(seconds=expiry)
 
         # SASトークンを生成する
         if self.connection_string:
-            blob_url = f"https://{self.blob_client.account_name}.blob.core.windows.net/{self.container_client.container_name}/{blob_name}"
             sas = generate_blob_sas(
                 account_name=self.container_client.account_name,
-                account_key=re.search(r"AccountKey=([^;]+)", self.connection_string).group(1),
+                account_key=self.account_key,
                 container_name=self.container_client.container_name,
                 blob_name=blob_name,
                 permission=BlobSasPermissions(read=read, write=write),
-                expiry=datetime.now(timezone.utc) + timedelta(seconds=expiry),
+                expiry=sas_expiry,
             )
         else:
-            blob_url = f"https://{self.blob_client.account_name}.blob.core.windows.net/{self.container_client.container_name}/{blob_name}"
             sas = generate_blob_sas(
                 account_name=self.container_client.account_name,
                 container_name=self.container_client.container_name,
                 blob_name=blob_name,
-                user_delegation_key=user_delegation_key,
+                user_delegation_key=self.__get_user_delegation_key(sas_expiry),
                 permission=BlobSasPermissions(read=read, write=write),
-                expiry=datetime.now(timezone.utc) + timedelta(seconds=expiry),
+                expiry=sas_expiry,
             )
 
         # SASトークンを含むBlobのURLを返す
         return f"{blob_url}?{sas}"
+
+    # SAS の有効期限まで有効なユーザー委任キーを返す
+    # キャッシュしたキーの有効期限が SAS の有効期限より前の場合は新しいキーを取得して返し、
+    # 有効期限が近づいている場合はキャッシュしたキーを返しつつ、バックグラウンドで新しいキーを取得する
+    def __get_user_delegation_key(self, valid_until: datetime):
+        cached = self.delegation_key
+        if cached is None or cached[1] < valid_until:
+            return self.__refresh_user_delegation_key(valid_until)
+
+        refresh_at = cached[1] - timedelta(seconds=AZURE_STORAGE_DELEGATION_KEY_REFRESH_MARGIN)
+        if refresh_at < datetime.now(timezone.utc) and not self.delegation_key_lock.locked():
+            threading.Thread(target=self.__refresh_user_delegation_key_in_background, daemon=True).start()
+        return cached[0]
+
+    # ユーザー委任キーを取得してキャッシュする
+    # (待っている間に他のスレッドが十分な有効期限のキーを取得した場合は、そのキーを返す)
+    def __refresh_user_delegation_key(self, valid_until: datetime):
+        with self.delegation_key_lock:
+            now = datetime.now(timezone.utc)
+            refresh_margin = timedelta(seconds=AZURE_STORAGE_DELEGATION_KEY_REFRESH_MARGIN)
+            cached = self.delegation_key
+            if cached is not None and cached[1] >= max(valid_until, now + refresh_margin):
+                return cached[0]
+
+            lifetime = max(timedelta(seconds=AZURE_STORAGE_DELEGATION_KEY_LIFETIME), valid_until - now + refresh_margin)
+            key_expiry_time = now + min(lifetime, timedelta(seconds=DELEGATION_KEY_MAX_LIFETIME))
+            key = self.blob_client.get_user_delegation_key(key_start_time=now, key_expiry_time=key_expiry_time)
+            self.delegation_key = (key, key_expiry_time)
+            return key
+
+    # バックグラウンドでユーザー委任キーを更新する(失敗した場合は、キーの有効期限が切れた時点で再度取得する)
+    def __refresh_user_delegation_key_in_background(self):
+        try:
+            self.__refresh_user_delegation_key(datetime.now(timezone.utc))
+        except Exception as e:
+            logger.warning(f"failed to refresh user delegation key: {e}")
@@ -1,8 +1,12 @@
 import os
+import gzip
+import json
 import uuid
-from typing import List, Dict
+import base64
+from typing import List, Dict, Any, Iterator, Tuple
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import TokenCredential
+from azure.core.pipeline.transport import HttpTransport
 from azure.cosmos.cosmos_client import CosmosClient
 from azure.cosmos.exceptions import CosmosResourceNotFoundError
 
@@ -10,6 +14,15 @@ COSMOS_ACCOUNT_NAME = os.getenv("AZURE_COSMOS_ACCOUNT_NAME")
 COSMOS_DB_NAME = os.getenv("AZURE_COSMOS_DB_NAME")
 COSMOS_CONTAINER_NAME = os.getenv("AZURE_COSMOS_CONTAINER_NAME")
 COSMOS_CONNECTION_STRING = os.getenv("AZURE_COSMOS_CONNECTION_STRING")
+COSMOS_OFFLOAD_THRESHOLD = int(os.getenv("AZURE_COSMOS_OFFLOAD_THRESHOLD", 64 * 1024))
+
+# 移行前のパーティション("0")も読み取り・クエリの対象とするか
+# (有効な間はクエリとポイント読み取りの失敗ごとに移行前のパーティションへのリクエストが増えるため、
+#  既存のアイテムが残っている環境で migrate_partitions.py を実行し終えるまでの間のみ有効にする)
+COSMOS_LEGACY_PARTITION_FALLBACK = os.getenv("AZURE_COSMOS_LEGACY_PARTITION_FALLBACK", "false").lower() == "true"
+
+# パーティション分割前にすべてのアイテムを格納していたパーティションキー
+LEGACY_PARTITION_KEY = "0"
 
 
 class CosmosContainer:
@@ -21,44 +34,254 @@ class CosmosContainer:
         container_name: str = None,
         credential: TokenCredential = DefaultAzureCredential(),
         connection_string: str = None,
+        transport: HttpTransport = None,
+        blob_container=None,  # BlobContainer
+        offload_fields: List[str] = None,
+        offload_threshold: int = None,
+        offload_prefix: str = "cosmos-offload/",
+        partition_key_field: str = None,
+        legacy_partition_fallback: bool = None,
     ):
         account_name = account_name or COSMOS_ACCOUNT_NAME
         db_name = db_name or COSMOS_DB_NAME
         container_name = container_name or COSMOS_CONTAINER_NAME
         connection_string = connection_string or COSMOS_CONNECTION_STRING
 
-        self.partition_key = "0"
+        # パーティションキー(pk)には partition_key_field で指定したフィールド(所有ユーザのIDなど)の値を格納する
+        # 指定しない場合は、すべてのアイテムを単一のパーティションに格納する
+        # 移行期間中(legacy_partition_fallback が有効な場合)は、新しいパーティションに存在しないアイテムを移行前のパーティションから読み込む
         self.partition_key_path = "pk"
+        self.partition_key_field = partition_key_field
+        if legacy_partition_fallback is None:
+            legacy_partition_fallback = COSMOS_LEGACY_PARTITION_FALLBACK
+        self.legacy_partition_fallback = legacy_partition_fallback and partition_key_field is not None
 
         if connection_string:
-            client = CosmosClient.from_connection_string(connection_string)
+            client = CosmosClient.from_connection_string(connection_string, transport=transport)
         else:
-            client = CosmosClient(url=f"https://{account_name}.documents.azure.com:443/", credential=credential)
+            client = CosmosClient(url=f"https://{account_name}.documents.azure.com:443/", credential=credential, transport=transport)
         database = client.get_database_client(db_name)
         self.container = database.get_container_client(container_name)
 
-    def query_items(self, query: str, parameters: List[Dict] = None) -> List[Dict]:
+        # サイズの大きいフィールドは Azure Blob Storage に退避し、アイテムには参照のみを格納する
+        self.blob_container = blob_container
+        self.offload_fields = offload_fields or []
+        self.offload_threshold = offload_threshold or COSMOS_OFFLOAD_THRESHOLD
+        self.offload_prefix = offload_prefix
+
+    def get_partition_key(self, item: dict) -> str:
+        """
+        アイテムを格納するパーティションのキーを取得します。
+
+        :param item: アイテム
+        :return: パーティションキー
+        """
+        if not self.partition_key_field:
+            return LEGACY_PARTITION_KEY
+        return item[self.partition_key_field]
+
+    def query_items(self, query: str, parameters: List[Dict] = None, partition_key: str = None) -> List[Dict]:
+        # パーティションキーを指定した場合は、そのパーティションのみを対象にクエリを実行する
+        # (移行期間中は、移行前のパーティションに残っているアイテムも対象とする)
+        if partition_key is not None:
+            items = [i for i in self.container.query_items(query, parameters=parameters, partition_key=partition_key)]
+            if self.legacy_partition_fallback and partition_key != LEGACY_PARTITION_KEY:
+                items += [i for i in self.container.query_items(query, parameters=parameters, partition_key=LEGACY_PARTITION_KEY)]
+            return items
         items = self.container.query_items(query, parameters=parameters, enable_cross_partition_query=True)
         return [i for i in items]
 
-    def get_item(self, id: str) -> Dict:
-        try:
-            return self.container.read_item(item=id, partition_key=self.partition_key)
-        except CosmosResourceNotFoundError:
-            return None
+    def query_page(
+        self,
+        query: str,
+        parameters: List[Dict] = None,
+        partition_key: str = None,
+        page_size: int = 100,
+        continuation_token: str = None,
+    ) -> Tuple[List[Dict], str]:
+        """
+        クエリの結果を1ページ分取得します。
+
+        :param query: クエリ
+        :param parameters: クエリのパラメータ
+        :param partition_key: クエリの対象とするパーティションのキー(指定しない場合は全パーティション)
+        :param page_size: 1ページあたりの最大件数
+        :param continuation_token: 前のページの取得時に返された継続トークン(指定しない場合は最初のページを取得する)
+        :return: (アイテムのリスト, 次のページを取得するための継続トークン(最後のページの場合は None))
+        """
+        return next(self.iter_query_pages(query, parameters, partition_key, page_size, continuation_token), ([], None))
+
+    def iter_query_pages(
+        self,
+        query: str,
+        parameters: List[Dict] = None,
+        partition_key: str = None,
+        page_size: int = 100,
+        continuation_token: str = None,
+    ) -> Iterator[Tuple[List[Dict], str]]:
+        """
+        クエリの結果をページ単位で返します。各ページには、次のページから取得を再開するための継続トークンが付与されます。
+        移行期間中は、指定したパーティションの結果に続けて、移行前のパーティションの結果を返します。
+        (ORDER BY による並び順はパーティションごとに適用され、2つのパーティションの結果をまたいだ並び順にはなりません)
+
+        :param query: クエリ
+        :param parameters: クエリのパラメータ
+        :param partition_key: クエリの対象とするパーティションのキー(指定しない場合は全パーティション)
+        :param page_size: 1ページあたりの最大件数
+        :param continuation_token: 取得を再開する位置を表す継続トークン
+        :return: (アイテムのリスト, 次のページを取得するための継続トークン(最後のページの場合は None)) のイテレータ
+        """
+        partition_keys = [partition_key]
+        if partition_key is not None and self.legacy_partition_fallback and partition_key != LEGACY_PARTITION_KEY:
+            partition_keys.append(LEGACY_PARTITION_KEY)
+
+        # 継続トークンから、取得を再開するパーティションと Cosmos DB の継続トークンを取り出す
+        partition_index, cosmos_token = self.__decode_continuation_token(continuation_token)
+        for i in range(partition_index, len(partition_keys)):
+            if partition_keys[i] is not None:
+                options = {"partition_key": partition_keys[i]}
+            else:
+                options = {"enable_cross_partition_query": True}
+            pager = self.container.query_items(query, parameters=parameters, max_item_count=page_size, **options).by_page(cosmos_token)
+            for page in pager:
+                items = [item for item in page]
+                if pager.continuation_token:
+                    next_token = self.__encode_continuation_token(i, pager.continuation_token)
+                elif i + 1 < len(partition_keys):
+                    next_token = self.__encode_continuation_token(i + 1, None)
+                else:
+                    next_token = None
+
+                # 続きのある空のページは返さずに次のページを取得する
+                if items or next_token is None:
+                    yield items, next_token
+                if next_token is None:
+                    return
+            cosmos_token = None
+
+    def get_item(self, id: str, partition_key: str = None) -> Dict:
+        # パーティションキーが分からない場合は、全パーティションを対象にIDで検索する
+        if partition_key is None and self.partition_key_field:
+            items = self.query_items("SELECT * FROM c WHERE c.id = @id", [{"name": "@id", "value": id}])
+            return items[0] if items else None
+
+        partition_keys = [partition_key or LEGACY_PARTITION_KEY]
+        if self.legacy_partition_fallback and partition_key != LEGACY_PARTITION_KEY:
+            partition_keys.append(LEGACY_PARTITION_KEY)
+        for pk in partition_keys:
+            try:
+                return self.container.read_item(item=id, partition_key=pk)
+            except CosmosResourceNotFoundError:
+                continue
+        return None
 
     def upsert_item(self, item: dict):
         try:
             if "id" not in item:
                 item["id"] = str(uuid.uuid4())
-            item[self.partition_key_path] = self.partition_key
-            item = self.container.upsert_item(item)
-            return item
+            previous_partition_key = item.get(self.partition_key_path)
+            item[self.partition_key_path] = self.get_partition_key(item)
+            upserted_item = self.container.upsert_item(self.__offload_fields(item))
+
+            # 移行前のパーティションから読み込んだアイテムは、新しいパーティションに書き込んだ後に移行前のアイテムを削除する
+            if self.legacy_partition_fallback and previous_partition_key == LEGACY_PARTITION_KEY != item[self.partition_key_path]:
+                self.__delete_from_partition(item["id"], LEGACY_PARTITION_KEY)
+            return upserted_item
         except CosmosResourceNotFoundError:
             return None
 
-    def delete_item(self, id: str):
+    def delete_item(self, id: str, partition_key: str = None) -> bool:
+        """
+        IDを指定してアイテムを削除します。
+
+        :param id: アイテムのID
+        :param partition_key: アイテムが格納されているパーティションのキー(指定しない場合は全パーティションから検索する)
+        :return: アイテムを削除したか(指定したパーティションに存在しない場合は False)
+        """
+        # パーティションキーが分からない場合は、アイテムを検索してパーティションキーを特定する
+        if partition_key is None and self.partition_key_field:
+            item = self.get_item(id)
+            if item is None:
+                return False
+            partition_key = item[self.partition_key_path]
+
+        deleted = self.__delete_from_partition(id, partition_key or LEGACY_PARTITION_KEY)
+
+        # 移行期間中は、移行前のパーティションに残っているアイテムも削除する
+        # (移行前のパーティションには全ユーザのアイテムが格納されているため、同じパーティションキーに属するアイテムのみを削除する)
+        if self.legacy_partition_fallback and partition_key != LEGACY_PARTITION_KEY:
+            try:
+                legacy_item = self.container.read_item(item=id, partition_key=LEGACY_PARTITION_KEY)
+                if self.get_partition_key(legacy_item) == partition_key:
+                    deleted = self.__delete_from_partition(id, LEGACY_PARTITION_KEY) or deleted
+            except CosmosResourceNotFoundError:
+                pass
+
+        # Azure Blob Storage に退避したフィールドも削除する
+        if deleted and self.blob_container:
+            for field in self.offload_fields:
+                self.blob_container.delete_blob(self.__get_offload_blob_name(id, field))
+        return deleted
+
+    def load_field(self, item: dict, field: str) -> Any:
+        """
+        アイテムのフィールドの値を取得します。Azure Blob Storage に退避されている場合はダウンロードして返します。
+
+        :param item: Cosmos DB から取得したアイテム
+        :param field: 取得するフィールド名
+        :return: フィールドの値(フィールドが存在しない場合は None)
+        """
+        value = item.get(field)
+        if not self.__is_offloaded(value):
+            return value
+        return json.loads(gzip.decompress(self.blob_container.download_bytes(value["blob_name"])))
+
+    # 退避対象のフィールドのうちサイズが閾値を超えるものを Azure Blob Storage に gzip 圧縮した JSON として保存し、
+    # 値を Blob への参照に置き換えたアイテムを返す(引数のアイテム自体は変更しない)
+    def __offload_fields(self, item: dict) -> dict:
+        if not self.blob_container:
+            return item
+        offloaded_item = dict(item)
+        for field in self.offload_fields:
+            value = item.get(field)
+            if value is None or self.__is_offloaded(value):
+                continue
+            data = json.dumps(value, ensure_ascii=False).encode()
+            if len(data) <= self.offload_threshold:
+                continue
+            blob_name = self.__get_offload_blob_name(item["id"], field)
+            self.blob_container.upload_bytes(blob_name, gzip.compress(data))
+            offloaded_item[field] = {"blob_name": blob_name, "size": len(data)}
+        return offloaded_item
+
+    # 取得を再開するパーティションの位置と Cosmos DB の継続トークンを、URL で受け渡しできる継続トークンに変換する
+    def __encode_continuation_token(self, partition_index: int, cosmos_token: str) -> str:
+        data = json.dumps({"partition": partition_index, "token": cosmos_token})
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    # 継続トークンから、取得を再開するパーティションの位置と Cosmos DB の継続トークンを取り出す
+    # (継続トークンが不正な場合は ValueError を送出する)
+    def __decode_continuation_token(self, continuation_token: str) -> Tuple[int, str]:
+        if not continuation_token:
+            return 0, None
         try:
-            self.container.delete_item(item=id, partition_key=self.partition_key)
+            data = json.loads(base64.urlsafe_b64decode(continuation_token.encode()))
+            return int(data["partition"]), data["token"]
+        except Exception as e:
+            raise ValueError(f"Invalid continuation token: {continuation_token}") from e
+
+    # 指定したパーティションからアイテムを削除し、削除したかを返す(アイテムが存在しない場合は何もしない)
+    def __delete_from_partition(self, id: str, partition_key: str) -> bool:
+        try:
+            self.container.delete_item(item=id, partition_key=partition_key)
+            return True
         except CosmosResourceNotFoundError:
-            pass
+            return False
+
+    # フィールドの値が Azure Blob Storage への参照かを判定する
+    def __is_offloaded(self, value: Any) -> bool:
+        return isinstance(value, dict) and set(value.keys()) == {"blob_name", "size"}
+
+    # 退避先の Blob の名前を生成する
+    def __get_offload_blob_name(self, id: str, field: str) -> str:
+        return f"{self.offload_prefix}{id}/{field}.json.gz"
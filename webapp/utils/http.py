@@ -0,0 +1,44 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+
+# ワーカーのすべてのスレッドが同時に同じホストへリクエストしてもコネクションを使い捨てないよう、
+# 1ホストあたりの最大コネクション数はワーカーのスレッド数(WEB_THREADS)を下回らないようにする
+WEB_THREADS = int(os.getenv("WEB_THREADS", 32))
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 8))
+HTTP_POOL_MAXSIZE = max(int(os.getenv("HTTP_POOL_MAXSIZE", WEB_THREADS * 2)), WEB_THREADS)
+
+
+def create_pooled_session(pool_connections: int = None, pool_maxsize: int = None) -> requests.Session:
+    """
+    Azure SDK の各クライアントで共有する、コネクションプール付きの HTTP セッションを生成します。
+
+    Args:
+        pool_connections (int, optional): 接続先ホストごとにキャッシュするプールの数。
+        pool_maxsize (int, optional): 1ホストあたりに保持する最大コネクション数。ワーカーのスレッド数以上を指定します。
+
+    Returns:
+        requests.Session: コネクションプール付きの HTTP セッション。
+    """
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections or HTTP_POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize or HTTP_POOL_MAXSIZE,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def create_transport(session: requests.Session) -> RequestsTransport:
+    """
+    共有の HTTP セッションを使用する Azure SDK のトランスポートを生成します。
+
+    Args:
+        session (requests.Session): 共有する HTTP セッション。
+
+    Returns:
+        RequestsTransport: Azure SDK のクライアントに渡すトランスポート。
+    """
+    return RequestsTransport(session=session, session_owner=False)
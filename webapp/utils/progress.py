@@ -0,0 +1,63 @@
+import json
+from typing import List, Tuple
+from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+
+
+class ProgressChannel:
+
+    def __init__(
+        self,
+        blob_container,  # BlobContainer
+        prefix: str = "progress/",
+    ):
+        self.blob_container = blob_container
+        self.prefix = prefix
+
+    def publish(self, doc_id: str, event: dict):
+        """
+        ドキュメントの処理の進捗イベントを発行します。イベントは追加Blobの末尾に JSON Lines 形式で追記されます。
+
+        :param doc_id: ドキュメントのID
+        :param event: 発行するイベント("type" キーでイベントの種類を表す)
+        """
+        data = json.dumps(event, ensure_ascii=False) + "\n"
+        self.blob_container.append_bytes(self.__get_blob_name(doc_id), data.encode())
+
+    def read(self, doc_id: str, offset: int = 0) -> Tuple[List[Tuple[int, dict]], int]:
+        """
+        指定した位置以降に発行された進捗イベントを取得します。
+
+        :param doc_id: ドキュメントのID
+        :param offset: 取得を開始する位置(前回の取得で返された位置)
+        :return: ((イベントの直後の位置, イベント) のリスト, 次回の取得を開始する位置)
+        """
+        try:
+            data = self.blob_container.download_bytes(self.__get_blob_name(doc_id), offset=offset)
+        except ResourceNotFoundError:
+            return [], offset
+        except HttpResponseError as e:
+            # 新たに追記されたイベントがない場合(指定した位置が Blob の末尾の場合)
+            if e.status_code == 416:
+                return [], offset
+            raise
+
+        # 改行で終わる行のみをイベントとして扱い、次回はその直後から取得する
+        events = []
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            events.append((offset, json.loads(line)))
+        return events, offset
+
+    def reset(self, doc_id: str):
+        """
+        ドキュメントの進捗イベントをすべて削除します。
+
+        :param doc_id: ドキュメントのID
+        """
+        self.blob_container.delete_blob(self.__get_blob_name(doc_id))
+
+    # 進捗イベントを格納する Blob の名前を生成する
+    def __get_blob_name(self, doc_id: str) -> str:
+        return f"{self.prefix}{doc_id}.jsonl"